@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Runs of a batch, the same sources rendered with different contexts.
+
+A batch manifest is a csv or a json file with a run for each row or
+object. `dest` is the output directory of the run, inside the destination
+directory, the other values override the sections of the configuration:
+a column like `info.name` sets the key `name` of the section `info`. In a
+json object a section can also be given as an object:
+
+    [{"dest": "acme", "info": {"name": "Acme"}, "tab.numberformat": "{0:.1f}"}]
+"""
+import copy
+import csv
+import json
+import os
+
+
+def read_runs(path):
+    """Return the runs of a batch manifest, a list of dictionaries with
+    the output directory and the overrides of the context
+    >>> with open('examples/runs.csv', 'w') as f:
+    ...     _ = f.write('dest,info.name\\nacme,Acme\\nbeta,Beta\\n')
+    >>> read_runs('examples/runs.csv')[1]
+    {'dest': 'beta', 'overrides': {'info.name': 'Beta'}}
+    >>> os.remove('examples/runs.csv')
+    """
+    with open(path, "r", newline="") as fman:
+        if os.path.splitext(path)[1].lower() == ".json":
+            rows = json.load(fman)
+            if isinstance(rows, dict):
+                rows = rows.get("runs", [])
+        else:
+            rows = list(csv.DictReader(fman))
+    runs = []
+    for i, row in enumerate(rows):
+        row = dict(row)
+        dest = row.pop("dest", None)
+        if not dest:
+            raise ValueError("Run {0} of {1} has no dest".format(i + 1, path))
+        runs.append({"dest": str(dest), "overrides": row})
+    return runs
+
+
+def get_context(default, overrides):
+    """Return a copy of the context with the overrides of a run
+    >>> default = {'info': {'name': 'Napoleone', 'surname': 'Bonaparte'}}
+    >>> context = get_context(default, {'info.name': 'Giuseppe',
+    ...                                 'tab': {'numberformat': '{0:.1f}'}})
+    >>> context['info'], context['tab']
+    ({'name': 'Giuseppe', 'surname': 'Bonaparte'}, {'numberformat': '{0:.1f}'})
+    >>> default['info']['name']
+    'Napoleone'
+    """
+    context = copy.deepcopy(default)
+    for key, value in overrides.items():
+        if isinstance(value, dict):
+            section = context.setdefault(key, {})
+            section.update(value)
+        elif "." in key:
+            section, name = key.split(".", 1)
+            context.setdefault(section, {})[name] = value
+        else:
+            context[key] = value
+    return context
+
+
+def report(ndocs, nruns, seconds):
+    """Print the throughput of a batch
+    >>> report(40, 10, 2.0)
+    Rendered 40 documents of 10 runs in 2.00 s, 20.0 documents/s
+    """
+    rate = ndocs / seconds if seconds > 0 else float("inf")
+    print(
+        "Rendered {0} documents of {1} runs in {2:.2f} s, {3:.1f} documents/s".format(
+            ndocs, nruns, seconds, rate
+        )
+    )
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the rendering hot paths.
+
+The workloads are generated in a temporary directory from a fixed seed:
+csv files from 10 to 10^6 rows and from 2 to 200 columns, trees with
+thousands of templates and assets, galleries with many images. Each
+benchmark runs a few times and reports its best time, the peak of the
+memory allocated by python (tracemalloc) and, for the builds, the time of
+each stage. The results can be saved and compared with a later run:
+
+$ python bench.py --save baseline.json
+$ python bench.py --compare baseline.json --threshold 0.2
+
+the comparison exits with an error if a benchmark is slower, or uses more
+memory, than the baseline by more than the threshold.
+"""
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from optparse import OptionParser
+
+import dirindex
+import dyn
+import filters
+import profiler
+import tables
+from manifest import MANIFEST
+
+# csv files: (rows, columns)
+CSVSIZES = {
+    "quick": [(10, 2), (1000, 20), (1000, 200), (50000, 20), (100000, 2)],
+    "full": [(10, 2), (1000, 200), (10000, 200), (100000, 20), (1000000, 2)],
+}
+# trees of sources: (templates, assets)
+TREESIZES = {"quick": [(100, 300)], "full": [(100, 300), (2000, 5000)]}
+# galleries: number of images
+GALLERYSIZES = {"quick": [200], "full": [200, 5000]}
+# images resized by the figure pipeline, only with Pillow
+DERIVATIVES = {"quick": 8, "full": 64}
+# files for each directory of the generated trees
+DIRSIZE = 100
+
+TEMPLATE = """\\section{{Template {0}}}
+{{{{ 'data.csv'|table(label='t:{0}', caption='Table {0}') }}}}
+{{{{ 'data.csv'|datatab(add_hline='0,-1') }}}}
+"""
+
+
+def make_csv(path, rows, cols, rng):
+    """Write a csv file with a name column and `cols - 1` numeric columns"""
+    with open(path, "w") as fcsv:
+        fcsv.write(",".join(["name"] + ["c%d" % i for i in range(1, cols)]) + "\n")
+        for row in range(rows):
+            values = ["%.4f" % (rng.random() * 1000) for _ in range(1, cols)]
+            fcsv.write(",".join(["row%d" % row] + values) + "\n")
+
+
+def make_tree(root, ntemplates, nassets, rng):
+    """Write a tree of templates, each reading a small csv, and assets"""
+    for i in range(max(ntemplates, nassets)):
+        directory = os.path.join(root, "dir%03d" % (i // DIRSIZE))
+        if i % DIRSIZE == 0:
+            os.makedirs(directory, exist_ok=True)
+            make_csv(os.path.join(directory, "data.csv"), 20, 5, rng)
+        if i < ntemplates:
+            with open(os.path.join(directory, "t%05d.tex" % i), "w") as ftmpl:
+                ftmpl.write(TEMPLATE.format(i))
+        if i < nassets:
+            with open(os.path.join(directory, "a%05d.txt" % i), "wb") as fasset:
+                fasset.write(bytes(rng.getrandbits(8) for _ in range(256)))
+
+
+def make_gallery(root, nimages, rng, size=None):
+    """Write a directory of images, real images of `size` with Pillow,
+    otherwise files with the right extension only"""
+    os.makedirs(root, exist_ok=True)
+    Image = None
+    if size:
+        from images import get_pil
+
+        Image = get_pil()
+    for i in range(nimages):
+        path = os.path.join(root, "img%05d.png" % i)
+        if Image is None:
+            with open(path, "wb") as fimg:
+                fimg.write(b"\x89PNG\r\n\x1a\n")
+        else:
+            color = tuple(rng.randrange(256) for _ in range(3))
+            Image.new("RGB", size, color).save(path)
+
+
+def hasmodule(name):
+    """Return True if an optional module can be imported"""
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+def measure(func, setup=None, repeat=3, memory=True):
+    """Return best and median time of `func`, and its peak of memory;
+    `setup` runs before each call and is not timed"""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    result = {"seconds": times[0], "median": times[len(times) // 2]}
+    if memory:
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            func()
+            result["peak"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def stages(func, setup=None):
+    """Return the time of each stage of a build, from the profiler"""
+    if setup:
+        setup()
+    prof = profiler.PROFILE
+    prof.collect()
+    prof.enabled = True
+    try:
+        func()
+    finally:
+        prof.enabled = False
+    totals = {}
+    for event in prof.collect():
+        totals[event["cat"]] = totals.get(event["cat"], 0) + event["dur"]
+    totals.pop("build", None)
+    return totals
+
+
+def get_benchmarks(workdir, size, rng):
+    """Generate the workloads inside `workdir` and return name, function,
+    setup and if the stages of the function are reported, for each
+    benchmark"""
+    benchmarks = []
+
+    def cold():
+        """Forget the parsed tables and the scanned directories"""
+        tables.TABLES.clear()
+        dirindex.INDEX.clear()
+
+    for rows, cols in CSVSIZES[size]:
+        path = os.path.join(workdir, "data_%d_%d.csv" % (rows, cols))
+        make_csv(path, rows, cols, rng)
+        label = "%dx%d" % (rows, cols)
+        data = tables.Table(path).rows
+        benchmarks += [
+            (
+                "get_cvsdata " + label,
+                lambda path=path: filters.get_cvsdata(path, ","),
+                cold,
+                False,
+            ),
+            (
+                "make_row " + label,
+                lambda data=data: filters.make_row(data, hline=[0, 1, -1]),
+                None,
+                False,
+            ),
+            (
+                "stream_rows " + label,
+                lambda path=path: "".join(filters.stream_rows(path, hline=[0, 1])),
+                None,
+                False,
+            ),
+        ]
+        if cols > 2 and hasmodule("numpy"):
+            benchmarks.append(
+                (
+                    "make_row numpy " + label,
+                    lambda data=data: filters.make_row(
+                        data, hline=[0, 1, -1], engine="numpy"
+                    ),
+                    None,
+                    False,
+                )
+            )
+        benchmarks.append(
+            (
+                "add_separator %d" % rows,
+                lambda rows=rows: filters.add_separator(
+                    list(range(rows)), [0, 1, 5, -1], None
+                ),
+                None,
+                False,
+            )
+        )
+
+    opt = {}
+    for ntemplates, nassets in TREESIZES[size]:
+        src = os.path.join(workdir, "tree_%d_%d" % (ntemplates, nassets))
+        dst = os.path.join(workdir, "build_%d_%d" % (ntemplates, nassets))
+        make_tree(src, ntemplates, nassets, rng)
+        label = "%d templates %d assets" % (ntemplates, nassets)
+
+        def clean(dst=dst):
+            cold()
+            shutil.rmtree(dst, ignore_errors=True)
+
+        def build(src=src, dst=dst, incremental=False):
+            dyn.processrc([src], opt, _dst=dst, incremental=incremental)
+
+        def built(build=build, dst=dst):
+            """Build once, the next incremental builds find nothing to do"""
+            cold()
+            if not os.path.isfile(os.path.join(dst, MANIFEST)):
+                build(incremental=True)
+                cold()
+
+        benchmarks += [
+            ("processrc " + label, build, clean, True),
+            (
+                "processrc incremental " + label,
+                lambda build=build: build(incremental=True),
+                built,
+                True,
+            ),
+        ]
+
+    for nimages in GALLERYSIZES[size]:
+        gallery = os.path.join(workdir, "gallery_%d" % nimages)
+        make_gallery(gallery, nimages, rng)
+        benchmarks.append(
+            (
+                "figure gallery %d" % nimages,
+                lambda gallery=gallery: filters.do_figure(gallery, col=4),
+                cold,
+                False,
+            )
+        )
+
+    if hasmodule("PIL"):
+        nimages = DERIVATIVES[size]
+        gallery = os.path.join(workdir, "photos_%d" % nimages)
+        figuredir = os.path.join(workdir, "figures")
+        make_gallery(gallery, nimages, rng, size=(2400, 1600))
+
+        def nofigures():
+            cold()
+            shutil.rmtree(figuredir, ignore_errors=True)
+            filters.setfigures(figuredir)
+
+        benchmarks.append(
+            (
+                "figure derivatives %d" % nimages,
+                lambda gallery=gallery: filters.do_figure(
+                    gallery, width="width=0.5\\textwidth", dpi=150
+                ),
+                nofigures,
+                False,
+            )
+        )
+    return benchmarks
+
+
+def run(size="quick", select=None, repeat=3, memory=True, seed=0, verbose=True):
+    """Run the benchmarks and return their results by name"""
+    rng = random.Random(seed)
+    workdir = tempfile.mkdtemp(prefix="dynbench")
+    odir = os.path.abspath(os.curdir)
+    results = {}
+    try:
+        # the builds work with paths relative to the working directory
+        os.chdir(workdir)
+        for name, func, setup, staged in get_benchmarks(os.curdir, size, rng):
+            if select and not any(sel in name for sel in select):
+                continue
+            result = measure(func, setup, repeat=repeat, memory=memory)
+            if staged:
+                result["stages"] = stages(func, setup)
+            results[name] = result
+            if verbose:
+                printresult(name, result)
+    finally:
+        filters.setfigures(None)
+        os.chdir(odir)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def printresult(name, result, base=None, threshold=0.1):
+    """Print a benchmark, compared with its baseline if given"""
+    peak = result.get("peak")
+    line = "{0:<45} {1:>10.2f} ms {2:>10}".format(
+        name,
+        result["seconds"] * 1000,
+        "-" if peak is None else "%.1f MB" % (peak / 2.0 ** 20),
+    )
+    if base:
+        line += "  {0:+7.1%}".format(result["seconds"] / base["seconds"] - 1)
+        if isregression(result, base, threshold):
+            line += "  REGRESSION"
+    print(line)
+    for stage, secs in sorted(result.get("stages", {}).items()):
+        print("    {0:<41} {1:>10.2f} ms".format(stage, secs * 1000))
+
+
+def isregression(result, base, threshold=0.1):
+    """Return True if the result is worse than the baseline by more than
+    `threshold`, in time or in memory
+    >>> isregression({'seconds': 1.3}, {'seconds': 1.0}, 0.2)
+    True
+    >>> isregression({'seconds': 1.1, 'peak': 100}, {'seconds': 1.0, 'peak': 100})
+    False
+    """
+    if result["seconds"] > base["seconds"] * (1 + threshold):
+        return True
+    if "peak" in result and "peak" in base:
+        return result["peak"] > base["peak"] * (1 + threshold)
+    return False
+
+
+def compare(results, baseline, threshold=0.1):
+    """Print the results against the baseline, return the names of the
+    benchmarks that regressed"""
+    regressions = []
+    print("Compared with the baseline, threshold {0:.0%}:".format(threshold))
+    for name, result in results.items():
+        base = baseline.get(name)
+        printresult(name, result, base, threshold)
+        if base and isregression(result, base, threshold):
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+    parser.add_option(
+        "--size",
+        dest="size",
+        default="quick",
+        help="Size of the workloads: quick or full, default is quick",
+        metavar="STRING",
+    )
+    parser.add_option(
+        "-k",
+        dest="select",
+        action="append",
+        default=None,
+        help="Run only the benchmarks whose name contains STRING",
+        metavar="STRING",
+    )
+    parser.add_option(
+        "-r",
+        "--repeat",
+        dest="repeat",
+        type="int",
+        default=3,
+        help="Times that each benchmark runs, the best is kept",
+        metavar="N",
+    )
+    parser.add_option(
+        "--no-memory",
+        action="store_false",
+        dest="memory",
+        default=True,
+        help="Do not measure the peak of memory",
+    )
+    parser.add_option(
+        "--seed",
+        dest="seed",
+        type="int",
+        default=0,
+        help="Seed of the generated workloads",
+        metavar="N",
+    )
+    parser.add_option(
+        "--save",
+        dest="save",
+        default=None,
+        help="Save the results as a baseline into FILE",
+        metavar="FILE",
+    )
+    parser.add_option(
+        "--compare",
+        dest="compare",
+        default=None,
+        help="Compare the results with the baseline in FILE",
+        metavar="FILE",
+    )
+    parser.add_option(
+        "--threshold",
+        dest="threshold",
+        type="float",
+        default=0.1,
+        help="Slowdown allowed before a regression, default is 0.1 (10%)",
+        metavar="FLOAT",
+    )
+    (options, args) = parser.parse_args()
+    if options.size not in CSVSIZES:
+        parser.error("size must be one of: %s" % ", ".join(sorted(CSVSIZES)))
+
+    results = run(
+        options.size,
+        options.select,
+        options.repeat,
+        options.memory,
+        options.seed,
+        verbose=not options.compare,
+    )
+    if options.save:
+        with open(options.save, "w") as fbase:
+            json.dump(
+                {"size": options.size, "seed": options.seed, "results": results},
+                fbase,
+                indent=1,
+                sort_keys=True,
+            )
+    if options.compare:
+        with open(options.compare, "r") as fbase:
+            baseline = json.load(fbase)["results"]
+        if compare(results, baseline, options.threshold):
+            sys.exit(1)
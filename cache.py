@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of the text produced by the filters.
+
+The fragments are stored in files named after the hash of their inputs:
+the content of the input file, the arguments of the filter and the
+version of the filters and of their templates. The cache is bounded in
+size, the least recently used fragments are removed first.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from dirindex import INDEX
+
+# default size of the fragment cache, in bytes
+MAXBYTES = 256 * 1024 * 1024
+
+_version = None
+# hash of the files already hashed in this process, by path and state
+_filehashes = {}
+
+
+def get_version():
+    """Return an hash of the filters and of their templates, a new version
+    of dynlatex produces different fragments"""
+    global _version
+    if _version is None:
+        sha = hashlib.sha1()
+        pkgdir = os.path.dirname(os.path.abspath(__file__))
+        names = ("filters.py", "tables.py", "query.py", "images.py", "dirindex.py")
+        names += ("database.py", "downsample.py")
+        paths = [os.path.join(pkgdir, name) for name in names]
+        tmpldir = os.path.join(pkgdir, "templates")
+        paths += [os.path.join(tmpldir, name) for name in sorted(os.listdir(tmpldir))]
+        for path in paths:
+            with open(path, "rb") as fil:
+                sha.update(hashlib.sha1(fil.read()).hexdigest().encode("ascii"))
+        _version = sha.hexdigest()
+    return _version
+
+
+def hashinput(path):
+    """Return an hash of the input of a filter: the content of a file, or
+    the list of the files of a directory. The hash of a file is computed
+    once per process while the file does not change"""
+    path = os.path.abspath(path)
+    if INDEX.isdir(path):
+        names = [
+            entry.name + ("/" if entry.isdir else "") for entry in INDEX.scan(path)
+        ]
+        return hashlib.sha1("\n".join(names).encode("utf-8")).hexdigest()
+    stat = os.stat(path)
+    state = (path, stat.st_mtime_ns, stat.st_size)
+    if state not in _filehashes:
+        sha = hashlib.sha1()
+        with open(path, "rb") as fil:
+            for block in iter(lambda: fil.read(1 << 20), b""):
+                sha.update(block)
+        _filehashes[state] = sha.hexdigest()
+    return _filehashes[state]
+
+
+class FragmentCache:
+    """A content addressed cache of text fragments in a directory
+    >>> import shutil
+    >>> cache = FragmentCache('build/.dyncache', maxbytes=10)
+    >>> key = cache.key('table', 'examples/some.csv', (), {'label': 'x'})
+    >>> cache.get(key) is None
+    True
+    >>> cache.put(key, 'some text')
+    >>> cache.get(key)
+    'some text'
+    >>> cache.put(cache.key('table', 'examples/some.csv', (), {}), 'evict the first')
+    >>> cache.get(key) is None
+    True
+    >>> cache.hits, cache.misses
+    (1, 2)
+    >>> shutil.rmtree('build/.dyncache')
+    """
+
+    def __init__(self, path, maxbytes=MAXBYTES):
+        self.path = os.path.join(path, "fragments")
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = None
+        # the counters and the size are shared by the threads of a server
+        self._lock = threading.Lock()
+
+    def key(self, name, path, args, kargs, state=None):
+        """Return the key of the fragment produced by a filter, the input is
+        identified by the hash of its content or by its `state`"""
+        state = hashinput(path) if state is None else state
+        inputs = [name, state, os.path.abspath(path), get_version()]
+        inputs.append(json.dumps([args, kargs], sort_keys=True, default=str))
+        return hashlib.sha1("\0".join(inputs).encode("utf-8")).hexdigest()
+
+    def getfile(self, key):
+        """Return the path of the file of a fragment"""
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """Return the fragment, None if it is not in the cache"""
+        path = self.getfile(key)
+        try:
+            with open(path, "r", encoding="utf-8") as fil:
+                text = fil.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        # the modification time is the last use
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return text
+
+    def put(self, key, text):
+        """Store a fragment, removing the oldest fragments if needed"""
+        path = self.getfile(key)
+        INDEX.makedir(os.path.dirname(path))
+        fd, tmppath = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        with os.fdopen(fd, "w", encoding="utf-8") as fil:
+            fil.write(text)
+        os.replace(tmppath, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            if self.nbytes is None:
+                self.nbytes = sum(size for _, size, _ in self.entries())
+            else:
+                self.nbytes += size
+            if self.nbytes > self.maxbytes:
+                self.evict(keep=path)
+
+    def entries(self):
+        """Return last use, size and path of the stored fragments"""
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries
+
+    def evict(self, keep=None):
+        """Remove the least recently used fragments until the cache fits,
+        called with the lock held"""
+        entries = sorted(self.entries())
+        self.nbytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.nbytes <= self.maxbytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.nbytes -= size
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Compile the rendered documents.
+
+Each root document is compiled by its own job on a bounded pool of
+workers. The command runs again only while the auxiliary files (.aux,
+.toc, ...) change, that is when latex needs another pass to get the cross
+references right. The output of each job goes to its own log.
+"""
+import hashlib
+import os
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# command used for each document, {document} is the path of the document
+# inside the destination directory and {name} its name without extension
+COMMAND = "pdflatex -interaction=nonstopmode -halt-on-error {document}"
+# files that change when latex needs another pass
+AUXEXT = (".aux", ".toc", ".lof", ".lot", ".out", ".nav", ".snm")
+# default maximum number of passes for a document
+MAXPASSES = 5
+
+
+def auxstate(cwd, name):
+    """Return the hash of the auxiliary files of a document"""
+    state = {}
+    for ext in AUXEXT:
+        path = os.path.join(cwd, name + ext)
+        if os.path.isfile(path):
+            with open(path, "rb") as faux:
+                state[ext] = hashlib.sha1(faux.read()).hexdigest()
+    return state
+
+
+def run(command, cwd, timeout=None, output=None):
+    """Run a shell command, return its exit code or None if it is killed
+    after `timeout` seconds. The whole process group is killed"""
+    posix = os.name == "posix"
+    proc = subprocess.Popen(
+        command,
+        shell=True,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=output,
+        stderr=subprocess.STDOUT if output else None,
+        start_new_session=posix,
+    )
+    try:
+        return proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        if posix:
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+        proc.wait()
+        return None
+
+
+def compiledoc(
+    document, command=COMMAND, cwd=".", timeout=None, maxpasses=MAXPASSES, logdir=None
+):
+    """Compile a document, running the command again while the auxiliary
+    files change. Return a dictionary with exit code, passes, time and log
+    >>> import shutil, tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> fake = 'test -f {name}.aux || echo ref > {name}.aux'
+    >>> result = compiledoc('main.tex', fake, cwd=tmp, logdir=tmp)
+    >>> result['returncode'], result['passes'], os.path.isfile(result['log'])
+    (0, 2, True)
+    >>> compiledoc('main.tex', fake, cwd=tmp)['passes']
+    1
+    >>> compiledoc('main.tex', 'exit 3', cwd=tmp)['returncode']
+    3
+    >>> compiledoc('main.tex', 'sleep 10', cwd=tmp, timeout=0.2)['timedout']
+    True
+    >>> shutil.rmtree(tmp)
+    """
+    name = os.path.splitext(os.path.basename(document))[0]
+    cmd = command.format(document=document, name=name)
+    log = None
+    if logdir:
+        os.makedirs(logdir, exist_ok=True)
+        log = os.path.join(logdir, document.replace(os.sep, "_") + ".log")
+    result = {
+        "document": document,
+        "returncode": 0,
+        "passes": 0,
+        "timedout": False,
+        "log": log,
+    }
+    start = time.time()
+    output = open(log, "w") if log else None
+    try:
+        state = auxstate(cwd, name)
+        while result["passes"] < int(maxpasses):
+            result["passes"] += 1
+            if output:
+                output.write("=== pass {0}: {1}\n".format(result["passes"], cmd))
+                output.flush()
+            returncode = run(cmd, cwd, timeout, output)
+            if returncode is None:
+                result["returncode"] = None
+                result["timedout"] = True
+                break
+            result["returncode"] = returncode
+            if returncode:
+                break
+            newstate = auxstate(cwd, name)
+            if newstate == state:
+                break
+            state = newstate
+    finally:
+        if output:
+            output.close()
+    result["seconds"] = time.time() - start
+    return result
+
+
+def compileall(
+    documents,
+    command=COMMAND,
+    cwd=".",
+    jobs=1,
+    timeout=None,
+    maxpasses=MAXPASSES,
+    logdir=None,
+):
+    """Compile the documents, `jobs` at the same time, return the results
+    in the same order of the documents"""
+    jobs = max(min(int(jobs), len(documents)), 1)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(compiledoc, doc, command, cwd, timeout, maxpasses, logdir)
+            for doc in documents
+        ]
+        return [future.result() for future in futures]
+
+
+def report(results):
+    """Print a line for each document, return True if all were compiled
+    >>> report([{'document': 'main.tex', 'returncode': 0, 'passes': 2,
+    ...          'timedout': False, 'seconds': 1.5, 'log': None}])
+    main.tex: ok, 2 passes in 1.50 s
+    True
+    """
+    success = True
+    for result in results:
+        if result["timedout"]:
+            status = "timed out"
+        elif result["returncode"]:
+            status = "failed (exit code {0})".format(result["returncode"])
+        else:
+            status = "ok"
+        line = "{0}: {1}, {2} pass{3} in {4:.2f} s".format(
+            result["document"],
+            status,
+            result["passes"],
+            "" if result["passes"] == 1 else "es",
+            result["seconds"],
+        )
+        if status != "ok":
+            success = False
+            if result["log"]:
+                line += ", see " + result["log"]
+        print(line)
+    return success
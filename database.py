@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Tables read from SQLite databases.
+
+The databases are opened read only and their connections are kept in a
+pool, shared by all the filter calls of a run, in all the templates. The
+rows are fetched from the cursor block by block, while the table is
+written. A database is identified by the modification time and the size
+of its file and of its write-ahead log, not by its content.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+# idle connections kept for each database
+POOLSIZE = 4
+# rows fetched from the cursor at a time
+BLOCKSIZE = 4096
+
+
+def connect(path):
+    """Open a database read only, sqlite3 and urllib (that imports http
+    and email) are imported only here"""
+    import sqlite3
+    from urllib.request import pathname2url
+
+    if not os.path.isfile(path):
+        raise FileNotFoundError("No such database: %r" % path)
+    uri = "file:{0}?mode=ro".format(pathname2url(os.path.abspath(path)))
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+
+class Pool:
+    """Idle connections to the databases, reused by the filter calls
+    >>> pool = Pool()
+    >>> import sqlite3
+    >>> sqlite3.connect('examples/pool.db').close()
+    >>> with pool.connection('examples/pool.db') as conn:
+    ...     first = conn
+    >>> with pool.connection('examples/pool.db') as conn:
+    ...     conn is first
+    True
+    >>> pool.opened, pool.reused
+    (1, 1)
+    >>> pool.close(); os.remove('examples/pool.db')
+    """
+
+    def __init__(self, size=POOLSIZE):
+        self.size = size
+        self.opened = 0
+        self.reused = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, path):
+        """Lend a connection to a database"""
+        key = os.path.abspath(path)
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+            if conn is None:
+                self.opened += 1
+            else:
+                self.reused += 1
+        if conn is None:
+            conn = connect(key)
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.size:
+                    idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def close(self):
+        """Close the idle connections, a new run opens the databases again"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+POOL = Pool()
+
+
+def iter_query(path, sql, params=()):
+    """Return an iterator over the rows of a query, the first row has the
+    names of the columns. The rows are fetched block by block
+    >>> import sqlite3
+    >>> with sqlite3.connect('examples/some.db') as conn:
+    ...     _ = conn.execute('CREATE TABLE t (name TEXT, weight REAL)')
+    ...     _ = conn.execute("INSERT INTO t VALUES ('Pippo', 58.8), ('Pluto', 17)")
+    >>> conn.close()
+    >>> list(iter_query('examples/some.db', 'SELECT * FROM t WHERE weight > ?', [20]))
+    [['name', 'weight'], ['Pippo', 58.8]]
+    >>> POOL.close(); os.remove('examples/some.db')
+    """
+    with POOL.connection(path) as conn:
+        cursor = conn.execute(sql, params or ())
+        try:
+            yield [column[0] for column in cursor.description or ()]
+            while True:
+                rows = cursor.fetchmany(BLOCKSIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield ["" if cell is None else cell for cell in row]
+        finally:
+            cursor.close()
+
+
+def count_query(path, sql, params=()):
+    """Return the number of rows of a query, without fetching them"""
+    with POOL.connection(path) as conn:
+        sql = "SELECT COUNT(*) FROM ({0})".format(sql.strip().rstrip(";"))
+        return conn.execute(sql, params or ()).fetchone()[0]
+
+
+def dbstate(path):
+    """Return the state of a database: modification time and size of the
+    file and of its write-ahead log"""
+    state = []
+    for name in (path, path + "-wal"):
+        try:
+            stat = os.stat(name)
+        except OSError:
+            continue
+        state.append("{0}:{1}".format(stat.st_mtime_ns, stat.st_size))
+    return " ".join(state)
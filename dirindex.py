@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the directories read in a run.
+
+Each directory is scanned once with os.scandir and the type of its
+entries is taken from the scan, so the figure filter and the copy of the
+sources share the same listing and never stat every entry again. The
+entries are sorted by name: galleries and copies follow the same order on
+every system. The index also remembers the directories made in the run,
+each missing directory is made once, without changing the working
+directory, so threads and processes can make directories at the same time.
+"""
+import fnmatch
+import os
+import re
+import threading
+from collections import namedtuple
+
+Entry = namedtuple("Entry", ["name", "isdir", "isfile"])
+
+
+class DirIndex:
+    """The sorted entries of the scanned directories
+    >>> index = DirIndex()
+    >>> [entry.name for entry in index.scan('examples')][:3]
+    ['copy.txt', 'main.tex', 'main.txt']
+    >>> index.isfile('examples/some.csv'), index.isfile('examples/none.csv')
+    (True, False)
+    >>> index.scan('examples/') == index.scan('examples'), index.scans
+    (True, 1)
+    >>> index.refresh(), index.scans
+    (0, 1)
+    """
+
+    def __init__(self):
+        self._dirs = {}
+        self._mtimes = {}
+        self._made = set()
+        self.scans = 0
+        # the threads of a server scan, refresh and clear at the same time
+        self._lock = threading.Lock()
+
+    def scan(self, path):
+        """Return the entries of a directory, scanning it only once"""
+        key = os.path.abspath(path)
+        entries = self._dirs.get(key)
+        if entries is None:
+            entries = {}
+            mtime = os.stat(key).st_mtime_ns
+            with os.scandir(key) as scanned:
+                for entry in scanned:
+                    try:
+                        isdir, isfile = entry.is_dir(), entry.is_file()
+                    except OSError:
+                        isdir = isfile = False
+                    entries[entry.name] = Entry(entry.name, isdir, isfile)
+            entries = {name: entries[name] for name in sorted(entries)}
+            with self._lock:
+                self._mtimes[key] = mtime
+                self._dirs[key] = entries
+                self.scans += 1
+        return list(entries.values())
+
+    def lookup(self, path):
+        """Return the entry of a path, None if its directory is not indexed
+        or if the path does not exist"""
+        parent, name = os.path.split(os.path.abspath(path))
+        entries = self._dirs.get(parent)
+        if entries is None:
+            return None
+        return entries.get(name, Entry(name, False, False))
+
+    def isfile(self, path):
+        """Return True if the path is a file, like os.path.isfile"""
+        entry = self.lookup(path)
+        return os.path.isfile(path) if entry is None else entry.isfile
+
+    def isdir(self, path):
+        """Return True if the path is a directory, like os.path.isdir"""
+        entry = self.lookup(path)
+        return os.path.isdir(path) if entry is None else entry.isdir
+
+    def makedir(self, path, force=False):
+        """Make a directory and its parents like `mkdir -p`, only the first
+        time it is asked in the run, or again with `force`
+        >>> index = DirIndex()
+        >>> index.makedir('build/a/b')
+        >>> os.path.isdir('build/a/b'), index.makedir('build/a/b')
+        (True, None)
+        >>> os.rmdir('build/a/b'); os.rmdir('build/a')
+        """
+        key = os.path.abspath(path)
+        if key in self._made and not force:
+            return
+        # makedirs with exist_ok is safe against other threads and processes
+        os.makedirs(key, exist_ok=True)
+        with self._lock:
+            self._made.add(key)
+
+    def removedir(self, path):
+        """Remove an empty directory, it will be made again if asked"""
+        key = os.path.abspath(path)
+        os.rmdir(key)
+        with self._lock:
+            self._made.discard(key)
+
+    def clear(self):
+        """Forget all the directories, to see the changes of a new run"""
+        with self._lock:
+            self._dirs.clear()
+            self._mtimes.clear()
+            self._made.clear()
+
+    def refresh(self):
+        """Forget only the directories changed since they were scanned or
+        made, a long running process sees the new files without scanning
+        again all the directories. Return how many were forgotten"""
+        with self._lock:
+            mtimes = list(self._mtimes.items())
+            made = list(self._made)
+        changed = [key for key, mtime in mtimes if not samemtime(key, mtime)]
+        gone = [key for key in made if not os.path.isdir(key)]
+        with self._lock:
+            for key in changed:
+                self._dirs.pop(key, None)
+                self._mtimes.pop(key, None)
+            self._made.difference_update(gone)
+        return len(changed)
+
+
+def samemtime(path, mtime):
+    """Return True if a directory still has the modification time"""
+    try:
+        return os.stat(path).st_mtime_ns == mtime
+    except OSError:
+        return False
+
+
+INDEX = DirIndex()
+
+
+def scan(path):
+    """Return the sorted entries of a directory, using the shared index"""
+    return INDEX.scan(path)
+
+
+def isfile(path):
+    """Return True if the path is a file, using the shared index"""
+    return INDEX.isfile(path)
+
+
+def makedir(path):
+    """Make a directory and its parents, using the shared index"""
+    INDEX.makedir(path)
+
+
+def get_patterns(patterns):
+    """Return the patterns as regular expressions, the patterns are globs
+    or regular expressions starting with 're:', separated by ','
+    >>> patterns = get_patterns('*.png, re:^fig[0-9]+, g*')
+    >>> [bool(pat.search('fig10.png')) for pat in patterns]
+    [True, True, False]
+    """
+    if not patterns:
+        return []
+    if isinstance(patterns, str):
+        patterns = patterns.split(",")
+    regexs = []
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if pattern.startswith("re:"):
+            regexs.append(re.compile(pattern[3:]))
+        elif pattern:
+            regexs.append(re.compile("^" + fnmatch.translate(pattern)))
+    return regexs
+
+
+def select(names, include=None, exclude=None):
+    """Return the names matching one of the `include` patterns and none
+    of the `exclude` patterns, without `include` all names match
+    >>> select(['a.png', 'b.jpg', 'a_draft.png'], '*.png', 're:_draft')
+    ['a.png']
+    """
+    include = get_patterns(include)
+    exclude = get_patterns(exclude)
+    return [
+        name
+        for name in names
+        if (not include or any(pat.search(name) for pat in include))
+        and not any(pat.search(name) for pat in exclude)
+    ]
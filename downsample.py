@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Downsampling of long series, for the plots.
+
+The points are read once, in order, without knowing how many they are:
+they are divided in buckets of consecutive points, and each bucket keeps
+only its lowest and its highest point. When the buckets are too many,
+the neighbours are merged two by two and the next buckets are twice as
+big, so the memory depends on the points kept, not on the series. Two
+methods keep the shape of the series:
+
+- minmax: the lowest and the highest point of each bucket, in order, the
+  peaks are never lost;
+- lttb, Largest Triangle Three Buckets: the points kept by minmax for
+  `RATIO` times the buckets are the candidates, from each bucket of the
+  candidates the point that makes the largest triangle with the point
+  chosen in the previous bucket and the average of the next bucket.
+
+The first and the last point are always kept, a series that is not
+longer than the points asked is left as it is.
+"""
+import math
+from functools import reduce
+from itertools import chain, islice
+
+METHODS = ("lttb", "minmax")
+# candidates of lttb for each point kept
+RATIO = 4
+
+
+def get_points(rows, x=0, y=1):
+    """Return an iterator over the points of the rows, the rows without
+    two finite numbers are skipped
+    >>> list(get_points([['1', '2.5'], ['a', '3'], ['2', 'nan'], ['3', '4']]))
+    [(1.0, 2.5), (3.0, 4.0)]
+    """
+    for row in rows:
+        try:
+            point = float(row[x]), float(row[y])
+        except (IndexError, TypeError, ValueError):
+            continue
+        if math.isfinite(point[0]) and math.isfinite(point[1]):
+            yield point
+
+
+def merge(first, second):
+    """Return the lowest and the highest of two buckets, the buckets are
+    [low, high] with the points as (position, point). On a tie the lowest
+    is the first and the highest the last, a flat bucket keeps two points"""
+    low = second[0] if second[0][1][1] < first[0][1][1] else first[0]
+    high = second[1] if second[1][1][1] >= first[1][1][1] else first[1]
+    return [low, high]
+
+
+def preselect(points, nbuckets):
+    """Return the first point, the lowest and the highest point of
+    `nbuckets` buckets of consecutive points in their order, and the last
+    point. The points are read once and their number is not needed
+    >>> series = [(i, (-1) ** i * i) for i in range(12)]
+    >>> preselect(iter(series), 2)
+    [(0, 0), (3, -3), (4, 4), (9, -9), (10, 10), (11, -11)]
+    """
+    points = iter(points)
+    first = next(points, None)
+    if first is None:
+        return []
+    buckets = []
+    current = None
+    size = 1
+    filled = 0
+    # a point enters the buckets when the next one is read, the last
+    # point is never in a bucket
+    held = None
+    for item in enumerate(points, 1):
+        if held is not None:
+            current = [held, held] if current is None else merge(current, [held, held])
+            filled += 1
+            if filled == size:
+                buckets.append(current)
+                current = None
+                filled = 0
+                if len(buckets) >= 2 * nbuckets:
+                    pairs = zip(buckets[::2], buckets[1::2])
+                    buckets = [merge(*pair) for pair in pairs]
+                    size *= 2
+        held = item
+    if current is not None:
+        buckets.append(current)
+    # the buckets are between nbuckets and twice as many, join them evenly
+    nbuckets = max(min(nbuckets, len(buckets)), 1)
+    bounds = [i * len(buckets) // nbuckets for i in range(nbuckets + 1)]
+    groups = [
+        reduce(merge, buckets[start:end])
+        for start, end in zip(bounds, bounds[1:])
+        if end > start
+    ]
+    selected = [first]
+    for low, high in groups:
+        for _, point in sorted({low, high}):
+            selected.append(point)
+    if held is not None:
+        selected.append(held[1])
+    return selected
+
+
+def buckets(points, npoints, nbuckets):
+    """Return an iterator over `nbuckets` lists of consecutive points,
+    the first and the last point are left out"""
+    every = (npoints - 2) / float(nbuckets)
+    start = 1
+    for i in range(nbuckets):
+        end = min(int((i + 1) * every) + 1, npoints - 1)
+        yield list(islice(points, end - start))
+        start = end
+
+
+def lttb(points, npoints, threshold):
+    """Return an iterator over `threshold` points chosen with the Largest
+    Triangle Three Buckets method
+    >>> series = [(i, 0) for i in range(10)]
+    >>> series[6] = (6, 5)
+    >>> list(lttb(iter(series), 10, 4))
+    [(0, 0), (4, 0), (6, 5), (9, 0)]
+    """
+    points = iter(points)
+    if threshold >= npoints or threshold < 3:
+        yield from points
+        return
+    seen = [None]
+    points = track(points, seen)
+    first = next(points, None)
+    if first is None:
+        return
+    yield first
+    chosen = first
+    groups = buckets(points, npoints, threshold - 2)
+    current = next(groups, [])
+    for following in groups:
+        # the average of the next bucket
+        if following:
+            avgx = sum(p[0] for p in following) / len(following)
+            avgy = sum(p[1] for p in following) / len(following)
+        else:
+            avgx, avgy = chosen
+        if current:
+            chosen = max(current, key=lambda p: area(chosen, p, avgx, avgy))
+            yield chosen
+        current = following
+    # the last bucket is compared with the last point, that is already
+    # read if the series is shorter than expected
+    rest = list(points)
+    end = rest[-1] if rest else seen[0]
+    current = [point for point in current if point is not end]
+    if current:
+        chosen = max(current, key=lambda p: area(chosen, p, end[0], end[1]))
+        yield chosen
+    if end is not chosen and end is not first:
+        yield end
+
+
+def track(points, seen):
+    """Return the points, keeping the last one read in `seen`"""
+    for point in points:
+        seen[0] = point
+        yield point
+
+
+def area(a, b, cx, cy):
+    """Return twice the area of the triangle a, b, c"""
+    return abs((a[0] - cx) * (b[1] - a[1]) - (a[0] - b[0]) * (cy - a[1]))
+
+
+def downsample(points, threshold, method="lttb"):
+    """Return an iterator over at most `threshold` points of a series, at
+    least 4. The series is read once
+    >>> series = [(i, 0) for i in range(1000)]
+    >>> series[500] = (500, 9)
+    >>> [len(list(downsample(iter(series), 50, method))) for method in METHODS]
+    [50, 50]
+    >>> (500, 9) in downsample(iter(series), 10, 'minmax')
+    True
+    >>> list(downsample(iter(series[:3]), 10))
+    [(0, 0), (1, 0), (2, 0)]
+    """
+    if method not in METHODS:
+        raise ValueError(
+            "Downsampling method must be one of: %s" % ", ".join(METHODS)
+        )
+    threshold = max(int(threshold), 4)
+    points = iter(points)
+    head = list(islice(points, threshold + 1))
+    if len(head) <= threshold:
+        return iter(head)
+    points = chain(head, points)
+    if method == "minmax":
+        return iter(preselect(points, (threshold - 2) // 2))
+    candidates = preselect(points, RATIO * threshold // 2)
+    return lttb(iter(candidates), len(candidates), threshold)
@@ -8,14 +8,31 @@ Dynamic LaTex Generator
 
 
 """
+import time
+
+# start of the imports, see --profile-startup
+_IMPORTSTART = time.perf_counter()
+
 import configparser
+import filecmp
 import os
 import shutil
 import sys
+import tempfile
+import threading
 from datetime import datetime
+from itertools import repeat
 from optparse import OptionParser
 
-from filters import Environment
+import database
+import dirindex
+import filters
+import profiler
+import sync
+from filters import basedir, get_document, outputdir, recording
+from manifest import Manifest, get_sections, getstat, hashfile
+
+IMPORTTIME = time.perf_counter() - _IMPORTSTART
 
 # print "where we are: ", os.getcwd()
 # print "where dyn.py is", os.path.abspath(__file__)
@@ -23,63 +40,121 @@ sys.path.append(os.path.abspath(__file__))
 
 
 def makedir(path):
-    """Create directories and subdirectories like `mkdir -p` """
-    directories = path.split(os.sep)
-    origdir = os.path.abspath(os.path.curdir)
-    # print 'makedir: ', path
-    for _ in directories:
-        if os.path.exists(_) == False:
-            os.mkdir(_)
-        os.chdir(_)
-    # return to the previous directory
-    os.chdir(origdir)
-
-
-def renderfile(_src, _dst, kargs):
+    """Create directories and subdirectories like `mkdir -p`, each directory
+    is created once per run and the working directory is never changed"""
+    dirindex.makedir(path)
+
+
+# permissions of the new files are the same of open(path, "w"). The umask
+# can only be read by setting it, so it is read once at import time, before
+# the threads of the jobs could create files with the temporary mask
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def renderfile(_src, _dst, kargs, root=None):
     """Generate a rendred file from a jinja template.
+    The file is rendered into a temporary file that replaces the old file
+    only if the content is different, return True if the file changed.
+    The paths of the files made by the filters are relative to `root`,
+    where the document is compiled.
     >>> makedir('build')
     >>> opt = {'info': {'surname': 'Bonaparte', 'name': 'Napoleone'}, 
     ...        'tab' : {'add_hline': '0,1,-1', 'col_layout': '0:l'}}
     >>> renderfile('examples/main.tex', 'build', opt)
+    True
     >>> os.path.isfile('build/main.tex')
     True
+    >>> renderfile('examples/main.tex', 'build', opt)
+    False
     >>> shutil.rmtree('build/')
     """
-    # load the template
-    with open(_src, "r") as srcfile:
-        srcbytes = srcfile.read()
-
-    template = Environment.from_string(srcbytes)
+    # load the template, compiled only if it is changed
+    template = get_document(_src)
     srcname = os.path.split(_src)[1]
     # get the new paths, for directory and file
     # newdirpath, newfilepath = get_newpath(_src, _dst)
     # no error if existing, make parent directories as needed
     newfilepath = os.path.join(_dst, srcname)
     makedir(_dst)  # like in a shell the comand "make -p"
-    with open(newfilepath, "w") as newf:
-        # record path, where we are as original directory
-        _odir = os.path.abspath(os.path.curdir)
-        # move into the directory contain the template
-        # in order to respect the path contained in the tempalate
-        os.chdir(os.path.split(_src)[0])
-        # do a render and write it to a file
-        # import pdb; pdb.set_trace()
-        try:
-            newf.write(template.render(**kargs))
-            newf.close()
-        except TypeError:
-            print(
-                ("\n".join(["{0} : {1}".format(k, v) for k, v in list(kargs.items())]))
-            )
-            raise TypeError(
-                "Are you calling in your template a dictionary or \
+    # render next to the output, a failed render never leaves a
+    # truncated file and os.replace is atomic on the same filesystem
+    try:
+        fd, tmppath = tempfile.mkstemp(
+            prefix="." + srcname + ".", suffix=".tmp", dir=_dst
+        )
+    except FileNotFoundError:
+        # the directory was removed after it was made in this run
+        dirindex.INDEX.makedir(_dst, force=True)
+        fd, tmppath = tempfile.mkstemp(
+            prefix="." + srcname + ".", suffix=".tmp", dir=_dst
+        )
+    try:
+        with os.fdopen(fd, "w") as newf:
+            # the paths contained in the template are relative to the
+            # directory of the template, they are resolved by the filters
+            # without moving into the directory, so templates can be rendered
+            # at the same time
+            # do a render and write it to a file
+            # import pdb; pdb.set_trace()
+            try:
+                with basedir(os.path.split(_src)[0]), outputdir(root):
+                    # write the chunks as soon as they are rendered, streamed
+                    # tables are never kept in memory
+                    newf.writelines(template.generate(**kargs))
+            except TypeError:
+                print(
+                    (
+                        "\n".join(
+                            ["{0} : {1}".format(k, v) for k, v in list(kargs.items())]
+                        )
+                    )
+                )
+                raise TypeError(
+                    "Are you calling in your template a dictionary or \
     obj not define in your configuration file?"
-            )
-    # could be a variable that as been wrong defined,
-    # for example if you delete the int() trasformation of col
-    # variable in filter.do_figure
-    # move back to original directory
-    os.chdir(_odir)
+                )
+        # could be a variable that as been wrong defined,
+        # for example if you delete the int() trasformation of col
+        # variable in filter.do_figure
+        if os.path.isfile(newfilepath) and filecmp.cmp(
+            tmppath, newfilepath, shallow=False
+        ):
+            # same content, keep the old file and its modification time
+            os.remove(tmppath)
+            return False
+        os.chmod(tmppath, 0o666 & ~_UMASK)
+        os.replace(tmppath, newfilepath)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+    return True
+
+
+def rendertemplate(_src, _dst, kargs, root=None):
+    """Render a template and return a dictionary with: the state of the
+    files read by its filters, the names that the template takes from the
+    configuration, the hash of the rendered file, if the rendered file
+    changed, the hits and misses of the fragment cache"""
+    cache = filters.fragments
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    with recording() as deps, profiler.span("render", _src) as info:
+        changed = renderfile(_src, _dst, kargs, root)
+        if profiler.enabled():
+            info["bytes"] = os.path.getsize(outputpath(_src, _dst))
+    with open(_src, "r") as srcfile:
+        sections = get_sections(srcfile.read())
+    return {
+        "deps": {dep: getstat(dep) for dep in sorted(deps)},
+        "sections": sections,
+        "output": hashfile(outputpath(_src, _dst)),
+        "changed": changed,
+        "hits": cache.hits - hits if cache else 0,
+        "misses": cache.misses - misses if cache else 0,
+        # the spans recorded by a worker are sent back to the main process
+        "events": profiler.PROFILE.collect(),
+    }
 
 
 def istemplate(_src, extensions=[".tex"]):
@@ -93,7 +168,7 @@ def istemplate(_src, extensions=[".tex"]):
     """
     ext = os.path.splitext(_src)[-1]
     # src is a template file
-    return os.path.isfile(_src) and (ext in extensions)
+    return (ext in extensions) and dirindex.isfile(_src)
 
 
 def copy(_src, _dst, link):
@@ -114,20 +189,47 @@ def copy(_src, _dst, link):
 
 
 def get_filelist(_src):
-    """Return a filelist given a path
+    """Return a filelist given a path, sorted by name
     >>> get_filelist('examples/') # doctest:+ELLIPSIS
-    ['examples/style.tex', ..., 'examples/some.csv']
+    ['examples/copy.txt', ..., 'examples/test.cfg']
     """
-    slist = os.listdir(_src)
     filelist = []
-    for _ in slist:
-        filelist.append(os.path.join(_src, _))
+    for entry in dirindex.scan(_src):
+        filelist.append(os.path.join(_src, entry.name))
     return filelist
 
 
-def processrc(srclist, default, _dst="build", srcext=[".tex",], link=False):
+def processrc(
+    srclist,
+    default,
+    _dst="build",
+    srcext=[".tex",],
+    link=False,
+    jobs=1,
+    incremental=False,
+    verbose=False,
+    cachedir=None,
+    bytecodedir=None,
+    figuredir=None,
+    assetmode="auto",
+    checksum=False,
+    warm=False,
+):
     """Process a list of file, understand if is a source file 
-    and using as a template for jinja, It work recursively in the directories
+    and using as a template for jinja, It work recursively in the directories.
+    With `jobs` greater than one the templates are rendered at the same time
+    by a pool of processes, the result is the same of a serial run.
+    With `incremental` a manifest in the destination directory records the
+    inputs of each output, and only the outputs with changed inputs are
+    rendered again. With `cachedir` the text produced by the filters is
+    kept in a persistent cache inside that directory, and with `bytecodedir`
+    the compiled templates are kept in a bytecode cache. The derivatives of
+    the figures, made by the `figure` filter with `dpi` or `fmt`, are
+    stored in `figuredir`. The other files are mirrored all together, only
+    if changed, as links with `link` or as `assetmode` copies (see sync.py).
+    With `warm` the caches, the index and the connections of the process
+    are in use by other threads (see runserver), they are kept and the
+    index only forgets the changed directories
     >>> opt = {'info': {'surname': 'Bonaparte', 'name': 'Napoleone'}, 
     ...        'tab' : {'add_hline': '0,1,-1', 'col_layout': '0:l'},
     ...        'euro': {'add_hline': '0,1,-1', 'col_layout': '0:l', 
@@ -143,7 +245,353 @@ def processrc(srclist, default, _dst="build", srcext=[".tex",], link=False):
     >>> directory.sort()
     >>> directory # doctest:+ELLIPSIS
     ['copy.txt', ..., 'test.cfg']
+    >>> serial = open('build/examples/style.tex').read()
+    >>> shutil.rmtree('build/')
+    >>> processrc(['examples/',], opt, srcext=['.tex',], link=True, jobs=2)
+    >>> open('build/examples/style.tex').read() == serial
+    True
+    >>> shutil.rmtree('build/')
+    >>> processrc(['examples/',], opt, link=True, incremental=True, verbose=True)
+    Mirrored 5 of 5 assets, 0 removed
+    Rendered 4 of 4 templates, 4 changed
+    >>> processrc(['examples/',], opt, link=True, incremental=True, verbose=True)
+    Mirrored 0 of 5 assets, 0 removed
+    Rendered 0 of 4 templates, 0 changed
+    >>> opt['euro']['numberformat'] = '{0:.1f} euro'
+    >>> processrc(['examples/',], opt, link=True, incremental=True, verbose=True)
+    Mirrored 0 of 5 assets, 0 removed
+    Rendered 1 of 4 templates, 1 changed
+    >>> processrc(['examples/',], opt, link=True, verbose=True)
+    Mirrored 0 of 5 assets, 0 removed
+    Rendered 4 of 4 templates, 0 changed
+    >>> processrc(['examples/',], opt, verbose=True, cachedir='build/.dyncache')
+    Mirrored 5 of 5 assets, 0 removed
+    Rendered 4 of 4 templates, 0 changed
+    Fragment cache: 0 hits, 5 misses
+    >>> processrc(['examples/',], opt, verbose=True, cachedir='build/.dyncache')
+    Mirrored 0 of 5 assets, 0 removed
+    Rendered 4 of 4 templates, 0 changed
+    Fragment cache: 5 hits, 0 misses
+    >>> processrc(['examples/main.tex', 'examples/simple.tex'], opt, verbose=True)
+    Mirrored 0 of 0 assets, 5 removed
+    Rendered 2 of 2 templates, 2 changed
+    >>> sorted(os.listdir('build/examples'))
+    ['main.tex', 'parameter.tex', 'simple.tex', 'style.tex']
     >>> shutil.rmtree('build/')"""
+    if warm:
+        dirindex.INDEX.refresh()
+    else:
+        # see the files changed since the last run
+        dirindex.INDEX.clear()
+        database.POOL.close()
+    templates = []
+    assets = []
+    with profiler.span("build", "copy sources"):
+        walksrc(srclist, templates, assets, _dst=_dst, srcext=srcext)
+        if os.name != "posix":
+            link = False
+        mirrored = sync.sync(
+            _dst,
+            assets,
+            mode="symlink" if link else assetmode,
+            checksum=checksum,
+            keep=[outputpath(_src, _tdst) for _src, _tdst in templates],
+        )
+    if not warm:
+        initworker(cachedir, bytecodedir, figuredir, profiler.enabled())
+    todo = templates
+    if incremental:
+        manifest = Manifest(_dst)
+        todo = [
+            (_src, _tdst)
+            for _src, _tdst in templates
+            if not manifest.uptodate(_src, outputpath(_src, _tdst), default)
+        ]
+    if jobs > 1 and len(todo) > 1:
+        # each template is independent, render them in different processes
+        from concurrent.futures import ProcessPoolExecutor
+
+        srcs, dsts = zip(*todo)
+        with profiler.span("build", "render templates"), ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=initworker,
+            initargs=(
+                cachedir,
+                bytecodedir,
+                figuredir,
+                profiler.enabled(),
+                figurejobs(jobs),
+            ),
+        ) as pool:
+            # consume the results to raise the errors of the workers
+            results = list(
+                pool.map(rendertemplate, srcs, dsts, repeat(default), repeat(_dst))
+            )
+    else:
+        with profiler.span("build", "render templates"):
+            results = [
+                rendertemplate(_src, _tdst, default, _dst) for _src, _tdst in todo
+            ]
+    for result in results:
+        profiler.PROFILE.merge(result.pop("events"))
+    if incremental:
+        for (_src, _tdst), result in zip(todo, results):
+            output = outputpath(_src, _tdst)
+            manifest.record(
+                _src,
+                output,
+                default,
+                result["deps"],
+                result["sections"],
+                result["output"],
+            )
+        manifest.save()
+    if verbose:
+        print(
+            "Mirrored {0} of {1} assets, {2} removed".format(
+                len(assets) - mirrored["skipped"], len(assets), mirrored["removed"]
+            )
+        )
+        changed = len([result for result in results if result["changed"]])
+        print(
+            "Rendered {0} of {1} templates, {2} changed".format(
+                len(todo), len(templates), changed
+            )
+        )
+        if cachedir:
+            print(
+                "Fragment cache: {0} hits, {1} misses".format(
+                    sum(result["hits"] for result in results),
+                    sum(result["misses"] for result in results),
+                )
+            )
+
+
+def rendertext(_src, kargs):
+    """Return the text rendered from a template, without writing it
+    >>> context = readcfg('examples/style.cfg'); _ = context.pop('general')
+    >>> context['info'] = {'name': 'Napoleone', 'surname': 'Bonaparte'}
+    >>> rendertext('examples/style.tex', context).splitlines()[0]
+    'Bonaparte - Napoleone'
+    """
+    template = get_document(_src)
+    with basedir(os.path.split(_src)[0]):
+        return template.render(**kargs)
+
+
+def runserver(address, options, cfg, default, cachedir, bytecodedir, figuredir):
+    """Serve render and build requests from a warm process, see serve.py.
+    The configuration file is read again when it changes"""
+    import batch
+    import serve
+    import tables
+
+    initworker(cachedir, bytecodedir, figuredir, profiler.enabled())
+    state = {"default": default, "mtime": getstat(cfg) if cfg else None}
+    buildlock = threading.Lock()
+    cfglock = threading.Lock()
+    srcext = options.srcext.replace(" ", "").split(",")
+
+    def getcontext(payload):
+        """Return the configuration with the overrides of a request"""
+        with cfglock:
+            if cfg and getstat(cfg) != state["mtime"]:
+                cfgopt = readcfg(cfg)
+                cfgopt.pop("general")
+                state["default"], state["mtime"] = cfgopt, getstat(cfg)
+            default = state["default"]
+        return batch.get_context(default, payload.get("context") or {})
+
+    def render(payload):
+        """Render a template and return its text"""
+        if not payload.get("template"):
+            raise ValueError("A render request needs a template")
+        kargs = getcontext(payload)
+        # see the files added and removed since the last request
+        dirindex.INDEX.refresh()
+        return {"text": rendertext(payload["template"], kargs)}
+
+    def build(payload):
+        """Build the sources into a destination directory"""
+        sources = payload.get("sources") or getattr(options, "source", None)
+        if not sources:
+            raise ValueError("A build request needs the sources")
+        dest = payload.get("dest") or options.dest
+        kargs = getcontext(payload)
+        start = time.perf_counter()
+        # the builds write the manifests, one at a time, while the renders
+        # go on: the build keeps the caches they use and renders in this
+        # process, a pool forked by a threaded process could deadlock
+        with buildlock:
+            processrc(
+                list(sources),
+                kargs,
+                _dst=dest,
+                srcext=srcext,
+                link=options.link,
+                jobs=1,
+                incremental=payload.get("incremental", True),
+                cachedir=cachedir,
+                bytecodedir=bytecodedir,
+                figuredir=figuredir,
+                assetmode=options.assets or "auto",
+                checksum=bool(options.checksum),
+                warm=True,
+            )
+        return {"dest": dest, "seconds": round(time.perf_counter() - start, 3)}
+
+    def caches():
+        """Return the state of the caches"""
+        fragments = filters.fragments
+        environment = filters.get_environment()
+        return {
+            "tables": {
+                "tables": len(tables.TABLES),
+                "bytes": tables.TABLES.nbytes,
+                "hits": tables.TABLES.hits,
+                "misses": tables.TABLES.misses,
+            },
+            "fragments": {
+                "hits": fragments.hits if fragments else 0,
+                "misses": fragments.misses if fragments else 0,
+            },
+            "templates": len(environment.cache or {}),
+            "scans": dirindex.INDEX.scans,
+        }
+
+    service = serve.Service(
+        {"render": render, "build": build},
+        workers=options.serveworkers or serve.WORKERS,
+        queue=serve.QUEUE if options.servequeue is None else options.servequeue,
+        caches=caches,
+    )
+    serve.serve(address, service, verbose=options.verbose)
+
+
+def renderrun(_src, _dst, kargs, root=None):
+    """Render a template of a batch run, return True if the file changed
+    and the spans recorded by the worker"""
+    with profiler.span("render", outputpath(_src, _dst)):
+        changed = renderfile(_src, _dst, kargs, root)
+    return changed, profiler.PROFILE.collect()
+
+
+def processbatch(
+    runs,
+    srclist,
+    default,
+    _dst="build",
+    srcext=[".tex",],
+    link=False,
+    jobs=1,
+    cachedir=None,
+    bytecodedir=None,
+    figuredir=None,
+    assetmode="auto",
+    checksum=False,
+):
+    """Render the sources once for each run of a batch (see batch.py), each
+    run in its own directory inside `_dst` and with its own context. The
+    templates are compiled once, before the pool of processes starts, and
+    the caches of the tables and of the filters are shared by all the runs.
+    Print the throughput and return the number of rendered documents
+    >>> runs = [{'dest': 'acme', 'overrides': {'info.name': 'Acme'}},
+    ...         {'dest': 'beta', 'overrides': {'info.name': 'Beta'}}]
+    >>> opt = readcfg('examples/style.cfg'); _ = opt.pop('general')
+    >>> opt['info'] = {'surname': 'Bonaparte', 'name': 'Napoleone'}
+    >>> processbatch(runs, ['examples/style.tex'], opt, jobs=2) # doctest:+ELLIPSIS
+    Rendered 2 documents of 2 runs in ... documents/s
+    2
+    >>> [open('build/%s/style.tex' % run).readline() for run in ('acme', 'beta')]
+    ['Bonaparte - Acme\\n', 'Bonaparte - Beta\\n']
+    >>> shutil.rmtree('build/')
+    """
+    import batch
+
+    dirindex.INDEX.clear()
+    database.POOL.close()
+    tasks = []
+    with profiler.span("build", "copy sources"):
+        for run in runs:
+            rundest = os.path.join(_dst, run["dest"])
+            kargs = batch.get_context(default, run["overrides"])
+            templates = []
+            assets = []
+            walksrc(srclist, templates, assets, _dst=rundest, srcext=srcext)
+            sync.sync(
+                rundest,
+                assets,
+                mode="symlink" if link and os.name == "posix" else assetmode,
+                checksum=checksum,
+                keep=[outputpath(_src, _tdst) for _src, _tdst in templates],
+            )
+            tasks.extend((_src, _tdst, kargs, rundest) for _src, _tdst in templates)
+    initworker(cachedir, bytecodedir, figuredir, profiler.enabled())
+    # the forked workers start with the compiled templates
+    for _src in sorted({task[0] for task in tasks}):
+        get_document(_src)
+    start = time.perf_counter()
+    if jobs > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        srcs, dsts, contexts, roots = zip(*tasks)
+        with profiler.span("build", "render templates"), ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=initworker,
+            initargs=(
+                cachedir,
+                bytecodedir,
+                figuredir,
+                profiler.enabled(),
+                figurejobs(jobs),
+            ),
+        ) as pool:
+            # few big chunks, a worker keeps its caches from task to task
+            chunksize = max(len(tasks) // (jobs * 4), 1)
+            results = list(
+                pool.map(renderrun, srcs, dsts, contexts, roots, chunksize=chunksize)
+            )
+    else:
+        with profiler.span("build", "render templates"):
+            results = [renderrun(*task) for task in tasks]
+    seconds = time.perf_counter() - start
+    for _, events in results:
+        profiler.PROFILE.merge(events)
+    batch.report(len(tasks), len(runs), seconds)
+    return len(tasks)
+
+
+def initworker(cachedir, bytecodedir, figuredir=None, profile=False, figjobs=None):
+    """Set the caches used to render the templates, `figjobs` threads make
+    the derivatives of the figures"""
+    filters.setcache(cachedir)
+    filters.setbytecode(bytecodedir)
+    filters.setfigures(figuredir, figjobs)
+    profiler.PROFILE.enabled = profile
+
+
+def figurejobs(jobs):
+    """Return the threads that make the figures in each of `jobs` worker
+    processes, together they use the processors once
+    >>> figurejobs(os.cpu_count() or 1), figurejobs(10 ** 6)
+    (1, 1)
+    """
+    return max((os.cpu_count() or 1) // max(jobs, 1), 1)
+
+
+def outputpath(_src, _dst):
+    """Return the path of the file rendered from a template
+    >>> outputpath('examples/main.tex', 'build/examples')
+    'build/examples/main.tex'
+    """
+    return os.path.join(_dst, os.path.split(_src)[1])
+
+
+def walksrc(srclist, templates, assets, _dst="build", srcext=[".tex",]):
+    """Walk recursively a list of file, make the directories of the
+    destination and append to `templates` the source and the destination
+    directory of the templates to render, and to `assets` the source and
+    the destination of the other files, to be mirrored all together"""
     if type(srclist) == list:
         # start the cicle to render all files
         for _src in srclist:
@@ -154,22 +602,11 @@ def processrc(srclist, default, _dst="build", srcext=[".tex",], link=False):
                 # print 'is a template src: ', _src
                 makedir(_dst)
                 # src is a file
-                renderfile(_src, _dst, default)
-            elif os.path.isfile(_src):
-                # src is file but not a templpate _dst
-                # check, if not unix link=False
-                # print 'is a file: ', _src
-                if os.name != "posix":
-                    link = False
+                templates.append((_src, _dst))
+            elif dirindex.isfile(_src):
+                # src is file but not a templpate
                 srcdir, srcname = os.path.split(_src)
-                try:
-                    makedir(_dst)
-                    copy(_src, os.path.join(_dst, srcname), link)
-                except OSError:
-                    # print "OSError: File exists ", os.path.join(_dst, srcname)
-                    # print " the file will not be copied
-                    # import pdb; pdb.set_trace()
-                    pass
+                assets.append((_src, os.path.join(_dst, srcname)))
             else:
                 # src is a directory
                 srcdir = os.path.split(_src)[1]
@@ -180,11 +617,57 @@ def processrc(srclist, default, _dst="build", srcext=[".tex",], link=False):
 
                 slist = get_filelist(_src)
                 # and then process
-                processrc(slist, default, _dst=_dst, srcext=srcext, link=link)
+                walksrc(slist, templates, assets, _dst=_dst, srcext=srcext)
     else:
         raise TypeError("Srclist must be a list here! ;-)")
 
 
+def compilepdf(
+    dest, pdfcommand, documents=None, jobs=1, timeout=None, maxpasses=None
+):
+    """Run the command that compiles the latex files inside `dest`, return
+    True if the command succeeded. With `documents` the command runs for
+    each document, `jobs` at the same time, and again while the auxiliary
+    files change; `{document}` and `{name}` in the command are replaced by
+    the document and its name, without them the default pdflatex command
+    is used"""
+    import compiler
+
+    if not documents:
+        print(("moving into: ", dest))
+        # run compile comand
+        print("Start to compile using: ")
+        print((pdfcommand))
+        print(("=" * 50))
+        returncode = compiler.run(pdfcommand, dest, timeout)
+        if returncode is None:
+            print("Compilation timed out after {0} s".format(timeout))
+        return returncode == 0
+    placeholders = ("{document}", "{name}")
+    if any(placeholder in pdfcommand for placeholder in placeholders):
+        command = pdfcommand
+    else:
+        command = compiler.COMMAND
+    results = compiler.compileall(
+        documents,
+        command,
+        cwd=dest,
+        jobs=jobs,
+        timeout=timeout,
+        maxpasses=maxpasses or compiler.MAXPASSES,
+        logdir=os.path.join(dest, CACHEDIR, "logs"),
+    )
+    return compiler.report(results)
+
+
+def profilestartup():
+    """Print the time spent to import and initialize dynlatex"""
+    print("Startup profile:")
+    print("  {0:<30} {1:8.1f} ms".format("dyn imports", IMPORTTIME * 1000))
+    for name, secs in filters.startup.items():
+        print("  {0:<30} {1:8.1f} ms".format(name, secs * 1000))
+
+
 class Option:
     """Define an empty object"""
 
@@ -230,6 +713,91 @@ def readgeneral(config):
     else:
         general.dest = "build"
 
+    if "jobs" in items:
+        general.jobs = config.getint("general", "jobs")
+    else:
+        general.jobs = 1
+
+    if "incremental" in items:
+        general.incremental = config.getboolean("general", "incremental")
+    else:
+        general.incremental = False
+
+    if "watch" in items:
+        general.watch = config.getboolean("general", "watch")
+    else:
+        general.watch = False
+
+    if "cache" in items:
+        general.cache = config.getboolean("general", "cache")
+    else:
+        general.cache = True
+
+    if "bytecodecache" in items:
+        general.bytecodecache = config.get("general", "bytecodecache")
+    else:
+        general.bytecodecache = None
+
+    if "assets" in items:
+        general.assets = config.get("general", "assets")
+    else:
+        general.assets = None
+
+    if "checksum" in items:
+        general.checksum = config.getboolean("general", "checksum")
+    else:
+        general.checksum = False
+
+    if "documents" in items:
+        general.documents = config.get("general", "documents")
+    else:
+        general.documents = None
+
+    if "compilejobs" in items:
+        general.compilejobs = config.getint("general", "compilejobs")
+    else:
+        general.compilejobs = 1
+
+    if "timeout" in items:
+        general.timeout = config.getfloat("general", "timeout")
+    else:
+        general.timeout = None
+
+    if "maxpasses" in items:
+        general.maxpasses = config.getint("general", "maxpasses")
+    else:
+        general.maxpasses = None
+
+    if "profile" in items:
+        general.profile = config.get("general", "profile")
+    else:
+        general.profile = None
+
+    if "profileformat" in items:
+        general.profileformat = config.get("general", "profileformat")
+    else:
+        general.profileformat = None
+
+    if "batch" in items:
+        general.batch = config.get("general", "batch")
+    else:
+        general.batch = None
+
+    if "serve" in items:
+        general.serve = config.get("general", "serve")
+    else:
+        general.serve = None
+
+    if "serveworkers" in items:
+        general.serveworkers = config.getint("general", "serveworkers")
+    else:
+        general.serveworkers = None
+
+    if "servequeue" in items:
+        general.servequeue = config.getint("general", "servequeue")
+    else:
+        general.servequeue = None
+
     if "source" in items:
         general.source = config.get("general", "source").replace(" ", "").split(",")
 
@@ -252,6 +820,30 @@ def readcfg(cfg):
     return opt
 
 
+# directory of the caches, inside the destination directory
+CACHEDIR = ".dyncache"
+
+# options of the command line that override the configuration file
+CMDLINE = [
+    "jobs",
+    "incremental",
+    "watch",
+    "cache",
+    "assets",
+    "checksum",
+    "documents",
+    "compilejobs",
+    "timeout",
+    "profile",
+    "profileformat",
+    "batch",
+    "serve",
+    "serveworkers",
+    "servequeue",
+    "verbose",
+]
+
+
 if __name__ == "__main__":
     usage = "usage: %prog [options] SOURCE"
     parser = OptionParser(usage)
@@ -305,6 +897,30 @@ if __name__ == "__main__":
  LaTex files",
         metavar="STRING",
     )
+    parser.add_option(
+        "--documents",
+        dest="documents",
+        default=None,
+        help="Root documents to compile inside the build directory, like:\
+ 'main.tex, slides.tex', each one is compiled by its own job",
+        metavar="STRING",
+    )
+    parser.add_option(
+        "--compile-jobs",
+        dest="compilejobs",
+        type="int",
+        default=None,
+        help="Number of documents compiled at the same time, default is 1",
+        metavar="N",
+    )
+    parser.add_option(
+        "--timeout",
+        dest="timeout",
+        type="float",
+        default=None,
+        help="Stop the compilation of a document after SECONDS",
+        metavar="SECONDS",
+    )
     parser.add_option(
         "-l",
         "--link",
@@ -315,12 +931,122 @@ if __name__ == "__main__":
         help="For not source files, make  a link the build\
  directory",
     )
+    parser.add_option(
+        "--assets",
+        dest="assets",
+        default=None,
+        help="How the files that are not templates are mirrored when they\
+ are not linked: auto, reflink, hardlink or copy, default is auto",
+        metavar="STRING",
+    )
+    parser.add_option(
+        "--checksum",
+        action="store_true",
+        dest="checksum",
+        default=None,
+        metavar="BOOLEAN",
+        help="Compare the content of the mirrored files, not only size and\
+ modification time",
+    )
+    parser.add_option(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type="int",
+        default=None,
+        help="Number of templates rendered at the same time, default is 1",
+        metavar="N",
+    )
+    parser.add_option(
+        "-u",
+        "--incremental",
+        action="store_true",
+        dest="incremental",
+        default=None,
+        metavar="BOOLEAN",
+        help="Render only the templates with changed inputs",
+    )
+    parser.add_option(
+        "-w",
+        "--watch",
+        action="store_true",
+        dest="watch",
+        default=None,
+        metavar="BOOLEAN",
+        help="Keep running and build again when the sources change",
+    )
+    parser.add_option(
+        "--no-cache",
+        action="store_false",
+        dest="cache",
+        default=None,
+        metavar="BOOLEAN",
+        help="Do not use the cache of the filters in the build directory",
+    )
+    parser.add_option(
+        "--profile-startup",
+        action="store_true",
+        dest="profilestartup",
+        default=False,
+        metavar="BOOLEAN",
+        help="Report the time spent to import and initialize dynlatex, the\
+ templates are rendered in this process, whatever -j",
+    )
+    parser.add_option(
+        "--profile",
+        dest="profile",
+        default=None,
+        help="Report the time spent by each template, copy and filter call\
+ and save the profile into FILE",
+        metavar="FILE",
+    )
+    parser.add_option(
+        "--profile-format",
+        dest="profileformat",
+        default=None,
+        help="Format of the profile: json or trace (Chrome trace), default\
+ is json",
+        metavar="STRING",
+    )
+    parser.add_option(
+        "--batch",
+        dest="batch",
+        default=None,
+        help="Render the sources once for each run of a manifest (csv or\
+ json) with the output directory and the overrides of the configuration",
+        metavar="FILE",
+    )
+    parser.add_option(
+        "--serve",
+        dest="serve",
+        default=None,
+        help="Keep running and serve render and build requests on ADDRESS:\
+ host:port, :port for localhost or the path of a Unix socket",
+        metavar="ADDRESS",
+    )
+    parser.add_option(
+        "--serve-workers",
+        dest="serveworkers",
+        type="int",
+        default=None,
+        help="Number of requests served at the same time, default is 4",
+        metavar="N",
+    )
+    parser.add_option(
+        "--serve-queue",
+        dest="servequeue",
+        type="int",
+        default=None,
+        help="Number of requests waiting for a worker, the next ones are\
+ refused, default is 16",
+        metavar="N",
+    )
     parser.add_option(
         "-v",
         "--verbose",
         action="store_true",
         dest="verbose",
-        default=False,
+        default=None,
         metavar="BOOLEAN",
         help="Get more Info",
     )
@@ -328,6 +1054,8 @@ if __name__ == "__main__":
     (options, args) = parser.parse_args()
 
     optcompile = options.compile
+    optcfg = options.cfg
+    optprofile = options.profilestartup
 
     # print '\n\n   dyn: ', os.getcwd()
     odir = os.path.abspath(os.path.curdir)
@@ -335,42 +1063,155 @@ if __name__ == "__main__":
     if options.cfg:
         print((options.cfg))
         opt = readcfg(options.cfg)
-        options = opt.pop("general")
+        cmdline, options = options, opt.pop("general")
+        # the options given in the command line win over the cfg file
+        for key in CMDLINE:
+            if getattr(cmdline, key) is not None:
+                setattr(options, key, getattr(cmdline, key))
     else:
         opt = {}
 
     if args:
         options.source = args
 
-    if options.source:
+    if optprofile:
+        # the workers of -j would import and initialize out of sight
+        options.jobs = 1
+
+    if options.profile:
+        profiler.PROFILE.enabled = True
+
+    def compiledest(dest=None):
+        """Compile the documents of the destination directory"""
+        documents = options.documents
+        if documents:
+            documents = documents.replace(" ", "").split(",")
+        return compilepdf(
+            dest or options.dest,
+            options.pdfcommand,
+            documents=documents,
+            jobs=options.compilejobs or 1,
+            timeout=options.timeout,
+            maxpasses=getattr(options, "maxpasses", None),
+        )
+
+    compiled = True
+    if getattr(options, "source", None) or options.serve:
         if options.dest == None:
             # destination is not define, then make a "build" directory
             # in the folder where we run the program
             options.dest = os.path.join(os.getcwd(), "build")
 
-        # Start to process sources
-        processrc(
-            options.source,
-            opt,
-            _dst=options.dest,
-            srcext=options.srcext.replace(" ", "").split(","),
-            link=options.link,
-        )
+        srcext = options.srcext.replace(" ", "").split(",")
+        cachedir = None
+        bytecodedir = getattr(options, "bytecodecache", None)
+        # the derivatives of the figures are part of the output
+        figuredir = os.path.join(options.dest, CACHEDIR, "figures")
+        if options.cache is not False:
+            cachedir = os.path.join(options.dest, CACHEDIR)
+            bytecodedir = bytecodedir or os.path.join(cachedir, "bytecode")
+        if options.serve:
+            runserver(
+                options.serve,
+                options,
+                optcfg,
+                opt,
+                cachedir,
+                bytecodedir,
+                figuredir,
+            )
+            optcompile = False
+        elif options.batch:
+            import batch
+
+            runs = batch.read_runs(options.batch)
+            processbatch(
+                runs,
+                options.source,
+                opt,
+                _dst=options.dest,
+                srcext=srcext,
+                link=options.link,
+                jobs=options.jobs or 1,
+                cachedir=cachedir,
+                bytecodedir=bytecodedir,
+                figuredir=figuredir,
+                assetmode=options.assets or "auto",
+                checksum=bool(options.checksum),
+            )
+            if optcompile:
+                # each run is compiled in its own directory
+                dests = [os.path.join(options.dest, run["dest"]) for run in runs]
+                compiled = all([compiledest(dest) for dest in dests])
+                optcompile = False
+        elif options.watch:
+            from watch import watch
+
+            def build():
+                """Build again the changed outputs, compile if needed"""
+                cfgopt = opt
+                if optcfg:
+                    # the configuration could be changed too
+                    cfgopt = readcfg(optcfg)
+                    cfgopt.pop("general")
+                before = Manifest(options.dest).hashes()
+                processrc(
+                    options.source,
+                    cfgopt,
+                    _dst=options.dest,
+                    srcext=srcext,
+                    link=options.link,
+                    jobs=options.jobs or 1,
+                    incremental=True,
+                    verbose=options.verbose,
+                    cachedir=cachedir,
+                    bytecodedir=bytecodedir,
+                    figuredir=figuredir,
+                    assetmode=options.assets or "auto",
+                    checksum=bool(options.checksum),
+                )
+                after = Manifest(options.dest).hashes()
+                changed = [out for out in after if before.get(out) != after[out]]
+                if optcompile and any(out.endswith(".tex") for out in changed):
+                    compiledest()
+
+            def getpaths():
+                """Return the sources and the files read by the filters"""
+                paths = list(options.source) + Manifest(options.dest).inputs()
+                return paths + [optcfg] if optcfg else paths
+
+            watch(build, getpaths, exclude=[options.dest])
+            optcompile = False
+        else:
+            # Start to process sources
+            processrc(
+                options.source,
+                opt,
+                _dst=options.dest,
+                srcext=srcext,
+                link=options.link,
+                jobs=options.jobs or 1,
+                incremental=bool(options.incremental),
+                verbose=options.verbose,
+                cachedir=cachedir,
+                bytecodedir=bytecodedir,
+                figuredir=figuredir,
+                assetmode=options.assets or "auto",
+                checksum=bool(options.checksum),
+            )
     else:
         print("Give me a latex source! Use cfg file or cmd line")
 
     if optcompile:
-        # change dir
-
-        odir = os.path.abspath(os.path.curdir)
-        print(("moving into: ", options.dest))
-        os.chdir(options.dest)
-        # run compile comand
-        print("Start to compile using: ")
-        print((options.pdfcommand))
-        print(("=" * 50))
-        os.system(options.pdfcommand)
+        compiled = compiledest()
+    if optprofile:
+        profilestartup()
+    if options.profile:
+        profiler.PROFILE.report()
+        profiler.PROFILE.save(options.profile, options.profileformat or "json")
     os.chdir(odir)
+    if not compiled:
+        sys.exit(1)
 
 
 # ===============================================================================
@@ -5,17 +5,245 @@ Created on Tue Jun 21 12:14:52 2011
 @author: Pietro Zambelli
 """
 
-import csv
+import configparser
+import hashlib
 import os
+import re
+import string
+import tempfile
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from itertools import chain, islice
+from time import perf_counter
 
-import jinja2
+import database
+from cache import MAXBYTES, FragmentCache, get_version
+from dirindex import isfile, scan, select
+from profiler import count, span
+from query import Query, Summary, get_names
+from tables import (
+    count_cols,
+    count_rows,
+    get_columns,
+    get_table,
+    isbinary,
+    iter_table,
+)
 
 
-def get_cvsdata(csvfile, delimiter):
-    """Return a list from a csv file"""
-    with open(csvfile, "r") as f_csv:
-        csvdata = csv.reader(f_csv, delimiter=delimiter)
-        return [r for r in csvdata]
+# directory of the template that is rendering, the relative paths given
+# to the filters are relative to this directory
+_basedir = ContextVar("basedir", default="")
+# set of the files read by the filters, while recording
+_deps = ContextVar("deps", default=None)
+# directory where the documents are compiled, the paths of the files made
+# by the filters are written relative to it
+_outputdir = ContextVar("outputdir", default=None)
+
+
+@contextmanager
+def basedir(path):
+    """Resolve the relative paths given to the filters against `path`,
+    instead of changing the working directory of the process
+    >>> with basedir('examples'):
+    ...     getpath('some.csv') == os.path.abspath('examples/some.csv')
+    True
+    >>> getpath('some.csv')
+    'some.csv'
+    """
+    token = _basedir.set(os.path.abspath(path))
+    try:
+        yield
+    finally:
+        _basedir.reset(token)
+
+
+def getpath(path):
+    """Return the path of a file read by a filter"""
+    path = os.path.join(_basedir.get(), path)
+    deps = _deps.get()
+    if deps is not None:
+        deps.add(os.path.abspath(path))
+    return path
+
+
+@contextmanager
+def outputdir(path):
+    """Write the paths of the files made by the filters relative to `path`,
+    the directory where the documents are compiled, without it they are
+    absolute
+    >>> with outputdir('build'):
+    ...     docpath('build/.dyncache/figures/ab.png')
+    '.dyncache/figures/ab.png'
+    >>> docpath('build/ab.png') == os.path.abspath('build/ab.png')
+    True
+    """
+    token = _outputdir.set(os.path.abspath(path) if path else None)
+    try:
+        yield
+    finally:
+        _outputdir.reset(token)
+
+
+def docpath(path):
+    """Return the path of a file made by a filter, as the document sees it"""
+    root = _outputdir.get()
+    if root is None:
+        return os.path.abspath(path)
+    return os.path.relpath(path, root)
+
+
+def isset(value):
+    """Return the truth of a flag given to a filter, the strings of the
+    configuration files are read like configparser does
+    >>> [isset(v) for v in (True, 'False', 'no', '0', 'off', 'on', '', None)]
+    [True, False, False, False, False, True, False, False]
+    """
+    if isinstance(value, str):
+        state = configparser.ConfigParser.BOOLEAN_STATES.get(value.strip().lower())
+        if state is not None:
+            return state
+    return bool(value)
+
+
+@contextmanager
+def recording():
+    """Record the files read by the filters
+    >>> with recording() as deps:
+    ...     path = getpath('examples/some.csv')
+    >>> deps == {os.path.abspath('examples/some.csv')}
+    True
+    """
+    deps = set()
+    token = _deps.set(deps)
+    try:
+        yield deps
+    finally:
+        _deps.reset(token)
+
+
+# time spent to import and initialize the lazy parts, in seconds
+startup = {}
+
+
+@contextmanager
+def timed(name):
+    """Record in `startup` the time spent in the block"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        startup[name] = startup.get(name, 0) + perf_counter() - start
+
+
+# persistent cache of the text produced by the filters, see setcache
+fragments = None
+# directory of the derivatives of the figures and threads that make
+# them, see setfigures
+_figuredir = None
+_figurejobs = None
+
+
+def setcache(path=None, maxbytes=MAXBYTES):
+    """Store the text produced by the filters in a cache inside `path`,
+    without a path the cache is disabled"""
+    global fragments
+    fragments = FragmentCache(path, maxbytes) if path else None
+
+
+def setfigures(path=None, jobs=None):
+    """Store the derivatives of the figures inside `path`, without a path
+    the figures are always used as they are. `jobs` threads make the
+    derivatives, all the processors if None"""
+    global _figuredir, _figurejobs
+    _figuredir = path
+    _figurejobs = jobs
+
+
+def cachedfilter(func, nocache=("stream",), inputstate=None):
+    """Return a filter that takes its text from the fragment cache, the
+    key is made by the input file, the arguments and the templates.
+    The calls with one of the `nocache` arguments skip the cache. The
+    input is identified by the hash of its content, or by `inputstate`"""
+    # name of the filter in the profile
+    name = func.__name__[3:] if func.__name__.startswith("do_") else func.__name__
+
+    @wraps(func)
+    def wrapper(path, *args, **kargs):
+        with span("filter", "{0} {1}".format(name, path)):
+            # a stream is never kept in memory, neither in the cache
+            if fragments is None or any(isset(kargs.get(arg)) for arg in nocache):
+                return func(path, *args, **kargs)
+            inpath = getpath(path)
+            state = inputstate(inpath) if inputstate else None
+            key = fragments.key(func.__name__, inpath, args, kargs, state)
+            text = fragments.get(key)
+            if text is None:
+                count("misses")
+                text = func(path, *args, **kargs)
+                fragments.put(key, text)
+            else:
+                count("hits")
+            return text
+
+    return wrapper
+
+
+def runtimefilter(func):
+    """Return a filter that jinja never calls while it compiles a template,
+    with constant arguments jinja would put the text of the filter in the
+    compiled template and the bytecode cache would keep it after the input
+    file changed"""
+    import jinja2
+
+    @wraps(func)
+    def wrapper(context, *args, **kargs):
+        return func(*args, **kargs)
+
+    return jinja2.pass_context(wrapper)
+
+
+def get_needed(csvfile, delimiter, query):
+    """Return the columns to read from a binary file, None for all"""
+    if query and isbinary(csvfile):
+        return query.prune(get_columns(csvfile, delimiter))
+    return None
+
+
+def get_cvsdata(csvfile, delimiter, query=None):
+    """Return a list from a csv file, the file is parsed only once
+    and then shared through the table cache. Only the rows and the columns
+    selected by `query` are returned, see query.Query"""
+    tab = get_table(csvfile, delimiter, get_needed(csvfile, delimiter, query))
+    if query:
+        return list(query.apply(tab.rows, tab))
+    return tab.rows
+
+
+class Stream:
+    """Text produced lazily, chunk by chunk. Looping over a stream in a
+    template writes the chunks straight into the output:
+
+        {% for chunk in 'big.csv'|table(stream=True) %}{{ chunk }}{% endfor %}
+
+    while converting the stream to a string joins all the chunks.
+    >>> stream = Stream(iter_rows, [[1, 2], [3, 4]], numberformat='{0:.0f}')
+    >>> print(stream)
+    1 & 2 \\\\
+    3 & 4 \\\\
+    """
+
+    def __init__(self, func, *args, **kargs):
+        self.func = func
+        self.args = args
+        self.kargs = kargs
+
+    def __iter__(self):
+        return iter(self.func(*self.args, **self.kargs))
+
+    def __str__(self):
+        return "".join(self)
 
 
 def datetimeformat(value, form="%H:%M / %d-%m-%Y"):
@@ -34,6 +262,34 @@ def add_separator(iterable, lines, separator):
     return iterable
 
 
+def get_positions(nrows, lines):
+    """Return for each separator the number of rows that precede it, using
+    the same rules of `add_separator` but without building the list
+    >>> get_positions(3, [0, 1, -1])
+    [0, 1, 3]
+    >>> rows = add_separator(['a', 'b', 'c', 'd'], [-2, 1, 7], None)
+    >>> rows
+    ['a', 'b', None, None, 'c', 'd', None]
+    >>> get_positions(4, [-2, 1, 7])
+    [2, 2, 4]
+    """
+    if nrows is None:
+        # without negative lines the number of rows is not needed
+        nrows = float("inf")
+    seps = []
+    for line in lines:
+        size = nrows + len(seps)
+        pos = (size if line == -1 else line) + len(seps)
+        # follow the rules of list.insert for the indexes out of range
+        if pos < 0:
+            pos = max(pos + size, 0)
+        pos = min(pos, size)
+        seps = [sep + 1 if sep >= pos else sep for sep in seps]
+        seps.append(pos)
+    seps.sort()
+    return [sep - i for i, sep in enumerate(seps)]
+
+
 def get_line(line):
     """Return the layout
     >>> get_line('0,-1')
@@ -54,15 +310,16 @@ def get_layout(layout):
         ]
 
 
-def do_columntab(csvfile, vline="", layout="", default="c", delimiter=","):
+def do_columntab(
+    csvfile, vline="", layout="", default="c", delimiter=",", columns=None
+):
     """Return a string with the column layout
     Create an example file
     
     >>> data = '''1;2;3
     ... 4;5;6'''
-    >>> dat = file('data.csv','w')
-    >>> dat.write(data)
-    >>> dat.close()
+    >>> with open('data.csv', 'w') as dat:
+    ...     _ = dat.write(data)
     >>> do_columntab('data.csv',delimiter=';')
     'ccc'
     >>> do_columntab('data.csv', default='r',delimiter=';')
@@ -75,9 +332,14 @@ def do_columntab(csvfile, vline="", layout="", default="c", delimiter=","):
     'lcc'
     >>> do_columntab('data.csv', layout = '0:l,1:c,2:r',delimiter=';')
     'lcr'
+    >>> do_columntab('data.csv', columns='2, 0', delimiter=';')
+    'cc'
+    >>> os.remove('data.csv')
     """
-    data = get_cvsdata(csvfile, delimiter)
-    ncols = len(data[0])
+    if columns:
+        ncols = len(get_names(columns))
+    else:
+        ncols = count_cols(getpath(csvfile), delimiter)
     vline = get_line(vline)
     layout = get_layout(layout)
     columns = [default] * ncols
@@ -90,7 +352,9 @@ def do_columntab(csvfile, vline="", layout="", default="c", delimiter=","):
     return "".join(columns)
 
 
-def make_row(data, hline=[], numberformat="{0:.2f}"):
+def make_row(
+    data, hline=[], numberformat="{0:.2f}", col_numberformat="", engine="python"
+):
     """Return data as require for a latex table
     >>> data = [[1,2,3],[4,5,6]]
     >>> print(make_row(data, numberformat = '{0:.0f}'))
@@ -111,18 +375,247 @@ def make_row(data, hline=[], numberformat="{0:.2f}"):
     Pippo & 58.79 & 1.83 \\\\
     Pluto & 16.98 & 0.61 \\\\
     \hline
+    >>> print(make_row(data, col_numberformat = '2:{0:.1f} m'))
+    Name & Weight & Heigth \\\\
+    Pippo & 58.79 & 1.8 m \\\\
+    Pluto & 16.98 & 0.6 m \\\\
+    """
+    return "".join(
+        iter_rows(
+            data,
+            hline=hline,
+            numberformat=numberformat,
+            col_numberformat=col_numberformat,
+            engine=engine,
+        )
+    )
+
+
+def get_colformat(colformat):
+    """Return a dictionary with the number format of each column, the
+    columns are separated by ';' because ',' could be part of the format
+    >>> get_colformat('1:{0:.1f}; 2:{0:,.0f} euro')
+    {1: '{0:.1f}', 2: '{0:,.0f} euro'}
+    """
+    if not colformat:
+        return {}
+    if isinstance(colformat, dict):
+        return {int(i): fmt for i, fmt in colformat.items()}
+    return {
+        int(i): fmt
+        for i, fmt in [c.strip().split(":", 1) for c in colformat.split(";")]
+    }
+
+
+def format_cell(dat, numberformat):
+    """Return a cell formatted as a number, or as it is if it is not a number
+    >>> format_cell('1.234', '{0:.1f}'), format_cell('Pippo', '{0:.1f}')
+    ('1.2', 'Pippo')
     """
-    rows = []
-    for row in data:
+    try:
+        return numberformat.format(float(dat))
+    except:
+        return str(dat)
+
+
+def format_python(rows, numberformat, colformats):
+    """Return the latex lines of a block of rows, formatting cell by cell"""
+    lines = []
+    for row in rows:
         r_new = []
-        for dat in row:
+        for i, dat in enumerate(row):
             try:
-                r_new.append(numberformat.format(float(dat)))
+                r_new.append(colformats.get(i, numberformat).format(float(dat)))
             except:
                 r_new.append(str(dat))
-        rows.append(" & ".join(r_new) + " \\\\")
-    rows = add_separator(rows, hline, "\hline")
-    return "\n".join(rows)
+        lines.append(" & ".join(r_new) + " \\\\")
+    return lines
+
+
+def get_numpy():
+    """Return the numpy module, numpy is needed only by the numpy engine"""
+    try:
+        with timed("numpy import"):
+            import numpy
+    except ImportError:
+        raise ImportError("The numpy engine requires numpy, try: pip install numpy")
+    return numpy
+
+
+# float format specs that printf formats in the same way, see get_printf
+_printfspec = re.compile(r"^([-+ ]?)(#?)(0?)(\d*)(\.\d+)?([eEfFgG])$")
+
+
+def get_printf(fmt):
+    """Return the printf format that formats a float as the number format
+    `fmt` does, None if there is none
+    >>> get_printf('{0:8.2f} euro'), get_printf('{0:+.1e}%'), get_printf('{0:,.0f}')
+    ('%8.2f euro', '%+.1e%%', None)
+    """
+    try:
+        parsed = list(string.Formatter().parse(fmt))
+    except ValueError:
+        return None
+    fields = [item for item in parsed if item[1] is not None]
+    if len(fields) != 1 or fields[0][1] not in ("0", "") or fields[0][3]:
+        return None
+    match = _printfspec.match(fields[0][2])
+    if not match:
+        return None
+    # '-' is the default sign of format, but left alignment for printf
+    sign = match.group(1).replace("-", "")
+    spec = "%" + sign + "".join(group or "" for group in match.groups()[1:])
+    printf = ""
+    for literal, field, _, _ in parsed:
+        printf += literal.replace("%", "%%") + (spec if field is not None else "")
+    return printf
+
+
+def _tofloat(cells, numpy):
+    """Convert a column to float in bulk, return the values and the mask of
+    the cells that are numbers. The failing cells are found splitting the
+    column in halves, so a column with only the header to skip costs few
+    conversions instead of one per cell"""
+    try:
+        return cells.astype(float), numpy.ones(len(cells), dtype=bool)
+    except (TypeError, ValueError, OverflowError):
+        if len(cells) <= 8:
+            values = numpy.zeros(len(cells))
+            mask = numpy.zeros(len(cells), dtype=bool)
+            for i, dat in enumerate(cells):
+                try:
+                    values[i] = float(dat)
+                    mask[i] = True
+                except:
+                    pass
+            return values, mask
+    half = len(cells) // 2
+    first, second = _tofloat(cells[:half], numpy), _tofloat(cells[half:], numpy)
+    return numpy.concatenate([first[0], second[0]]), numpy.concatenate(
+        [first[1], second[1]]
+    )
+
+
+def format_numpy(rows, numberformat, colformats):
+    """Return the latex lines of a block of rows. The numbers are converted
+    by numpy column by column and each row is formatted by a single printf
+    template; the rows with a cell that is not a number in a numeric column,
+    like the header, and the number formats that printf does not know are
+    formatted as `format_python` does. The result is the same
+    >>> rows = [['Name', 'Weight'], ['Pippo', '58.789'], ['Pluto', 16.983]]
+    >>> format_numpy(rows, '{0:.1f}', {}) == format_python(rows, '{0:.1f}', {})
+    True
+    >>> colformats = {1: '{0:,.0f} g'}
+    >>> format_numpy(rows, '', colformats) == format_python(rows, '', colformats)
+    True
+    >>> huge = [['Pippo', 10 ** 400, 1.5], ['Pluto', 16.983, 10 ** 400]]
+    >>> format_numpy(huge, '{0:.1f}', {}) == format_python(huge, '{0:.1f}', {})
+    True
+    """
+    numpy = get_numpy()
+    ncols = len(rows[0]) if rows else 0
+    if not ncols or any(len(row) != ncols for row in rows):
+        # ragged rows, there are no columns to work on
+        return format_python(rows, numberformat, colformats)
+    # numpy converts None and other objects differently from float()
+    if not set(map(type, chain.from_iterable(rows))) <= {str, float, int, bool}:
+        return format_python(rows, numberformat, colformats)
+    cells = numpy.array(rows, dtype=object)
+    if cells.ndim != 2:
+        return format_python(rows, numberformat, colformats)
+    # the rows that the template cannot format
+    other = numpy.zeros(len(rows), dtype=bool)
+    template = []
+    args = []
+    for i in range(ncols):
+        fmt = colformats.get(i, numberformat)
+        column = cells[:, i]
+        try:
+            # a label column: the cells are not numbers, skip the bulk conversion
+            float(column[-1])
+        except (TypeError, ValueError, OverflowError):
+            args.append([format_cell(dat, fmt) for dat in column])
+            template.append("%s")
+            continue
+        values, mask = _tofloat(column, numpy)
+        printf = get_printf(fmt)
+        if printf is not None:
+            args.append(values.tolist())
+            other |= ~mask
+            template.append(printf)
+            continue
+        try:
+            formatted = list(map(fmt.format, values[mask].tolist()))
+        except:
+            # the format is not valid for floats, use the python rules
+            formatted = [format_cell(dat, fmt) for dat in column[mask]]
+        column = column.copy()
+        column[mask] = formatted
+        column[~mask] = [str(dat) for dat in column[~mask]]
+        args.append(column.tolist())
+        template.append("%s")
+    template = " & ".join(template) + " \\\\"
+    lines = list(map(template.__mod__, zip(*args)))
+    for i in numpy.flatnonzero(other):
+        lines[i] = format_python([rows[i]], numberformat, colformats)[0]
+    return lines
+
+
+formatters = {"python": format_python, "numpy": format_numpy}
+
+# number of rows formatted together by the engines
+BLOCKSIZE = 4096
+
+
+def iter_rows(
+    data,
+    hline=[],
+    numberformat="{0:.2f}",
+    nrows=None,
+    col_numberformat="",
+    engine="python",
+):
+    """Return an iterator over the lines of a latex table, every line but
+    the first one starts with a new line. The data are consumed row by row,
+    the number of rows is used only to place the negative hlines
+    >>> data = [['Pippo', 58.789], ['Pluto', 16.983]]
+    >>> print("".join(iter_rows(iter(data), hline=[0, 5])))
+    \\hline
+    Pippo & 58.79 \\\\
+    Pluto & 16.98 \\\\
+    \\hline
+    """
+    if engine not in formatters:
+        raise ValueError(
+            "Table engine must be one of: %s" % ", ".join(sorted(formatters))
+        )
+    formatter = formatters[engine]
+    colformats = get_colformat(col_numberformat)
+    positions = []
+    if hline:
+        if nrows is None and any(line < 0 for line in hline):
+            nrows = len(data)
+        positions = get_positions(nrows, hline)
+    sep = 0
+    newline = ""
+    i = 0
+    data = iter(data)
+    while True:
+        block = list(islice(data, BLOCKSIZE))
+        if not block:
+            break
+        count("rows", len(block))
+        for line in formatter(block, numberformat, colformats):
+            while sep < len(positions) and positions[sep] <= i:
+                yield newline + "\\hline"
+                newline = "\n"
+                sep += 1
+            yield newline + line
+            newline = "\n"
+            i += 1
+    for _ in positions[sep:]:
+        yield newline + "\\hline"
+        newline = "\n"
 
 
 def transforminput(vline, hline, layout):
@@ -140,13 +633,105 @@ def transforminput(vline, hline, layout):
     return vline, hline, layout
 
 
-def do_datatab(csvfile, delimiter=",", numberformat="{0:.2f}", add_hline=""):
-    """Return only the data formating as latex
+def stream_rows(
+    csvfile,
+    delimiter=",",
+    numberformat="{0:.2f}",
+    hline=[],
+    col_numberformat="",
+    engine="python",
+    query=None,
+):
+    """Return an iterator over the lines of a latex table reading the csv
+    file row by row, the rows are counted only if there are negative hlines.
+    The rows selected by `query` are kept in memory only if they have to
+    be counted
+    """
+    nrows = None
+    rows = iter_table(csvfile, delimiter, get_needed(csvfile, delimiter, query))
+    negative = hline and any(line < 0 for line in hline)
+    if query:
+        rows = query.apply(rows)
+        if negative:
+            rows = list(rows)
+    elif negative:
+        nrows = count_rows(csvfile, delimiter)
+    return iter_rows(
+        rows,
+        hline=hline,
+        numberformat=numberformat,
+        nrows=nrows,
+        col_numberformat=col_numberformat,
+        engine=engine,
+    )
+
+
+def split_head(lines, header=1):
+    """Split the lines of a table, as given by iter_rows, into the header,
+    the first `header` rows with their hlines, and an iterator over the
+    other lines. The lines lose the leading new line
+    >>> head, rest = split_head(iter(['\\\\hline', '\\na \\\\\\\\', '\\n\\\\hline',
+    ...                               '\\n1 \\\\\\\\', '\\n2 \\\\\\\\']))
+    >>> head, list(rest)
+    (['\\\\hline', 'a \\\\\\\\', '\\\\hline'], ['1 \\\\\\\\', '2 \\\\\\\\'])
+    """
+    lines = (line[1:] if line.startswith("\n") else line for line in lines)
+    head = []
+    if header <= 0:
+        return head, lines
+    rows = 0
+    for line in lines:
+        if line == "\\hline":
+            head.append(line)
+            continue
+        if rows == header:
+            return head, chain([line], lines)
+        head.append(line)
+        rows += 1
+    return head, iter(())
+
+
+def iter_chunks(lines, size):
+    """Return an iterator over lists of lines with at most `size` rows, an
+    hline after the last row of a chunk stays in the chunk
+    >>> list(iter_chunks(['1', '2', '\\\\hline', '3'], 2))
+    [['1', '2', '\\\\hline'], ['3']]
+    """
+    chunk = []
+    rows = 0
+    for line in lines:
+        if line != "\\hline":
+            if rows == size:
+                yield chunk
+                chunk = []
+                rows = 0
+            rows += 1
+        chunk.append(line)
+    if chunk:
+        yield chunk
+
+
+def do_datatab(
+    csvfile,
+    delimiter=",",
+    numberformat="{0:.2f}",
+    add_hline="",
+    stream=False,
+    col_numberformat="",
+    engine="python",
+    columns=None,
+    where=None,
+    sort_by=None,
+    limit=None,
+):
+    """Return only the data formating as latex, `columns`, `where`,
+    `sort_by` and `limit` select the rows and the columns of the csv while
+    it is read, see query.Query
     >>> import csv
     >>> data = [['Name', 'Weight', 'Heigth'],
     ...         ['Pippo', 58.789, 1.828],
     ...         ['Pluto', 16.983, 0.608]]
-    >>> with open('examples/some.csv', 'wb') as f:
+    >>> with open('examples/some.csv', 'w', newline='') as f:
     ...     writer = csv.writer(f)
     ...     writer.writerows(data)
     >>> print(do_datatab('examples/some.csv', delimiter=',', add_hline='0,-1'))
@@ -155,11 +740,34 @@ def do_datatab(csvfile, delimiter=",", numberformat="{0:.2f}", add_hline=""):
     Pippo & 58.79 & 1.83 \\\\
     Pluto & 16.98 & 0.61 \\\\
     \hline
+    >>> print(do_datatab('examples/some.csv', columns='Name, Heigth',
+    ...                  where='Weight < 50', sort_by='-Heigth', limit=5))
+    Name & Heigth \\\\
+    Pluto & 0.61 \\\\
     """
     # print 'inset data Table from file: ', csvfile
-    csvdata = get_cvsdata(csvfile, delimiter)
+    csvfile = getpath(csvfile)
     add_hline = get_line(add_hline)
-    return make_row(csvdata, hline=add_hline, numberformat=numberformat)
+    query = Query(columns, where, sort_by, limit)
+    if isset(stream):
+        return Stream(
+            stream_rows,
+            csvfile,
+            delimiter,
+            numberformat,
+            add_hline,
+            col_numberformat=col_numberformat,
+            engine=engine,
+            query=query,
+        )
+    csvdata = get_cvsdata(csvfile, delimiter, query)
+    return make_row(
+        csvdata,
+        hline=add_hline,
+        numberformat=numberformat,
+        col_numberformat=col_numberformat,
+        engine=engine,
+    )
 
 
 def do_table(
@@ -174,13 +782,34 @@ def do_table(
     label="",
     caption="",
     more="\\scriptsize \n  \\centering",
+    mode="table",
+    stream=False,
+    col_numberformat="",
+    engine="python",
+    split_rows=0,
+    header_rows=1,
+    continued="continued",
+    columns=None,
+    where=None,
+    sort_by=None,
+    limit=None,
 ):
-    """Read a csv file and return a LaTex table
+    """Read a csv file and return a LaTex table, `mode` could be 'table' or
+    'longtable' for tables that span several pages. With `stream` the csv
+    file is read row by row while the table is written. `col_numberformat`
+    set the number format of single columns, like '1:{0:.1f}; 2:{0:.0f}',
+    and `engine` could be 'python' or 'numpy' to format the numbers of a
+    column all together. With `split_rows` a table is split in a sequence
+    of tables with at most `split_rows` rows each, a longtable is given to
+    latex in chunks of `split_rows` rows. The first `header_rows` rows are
+    repeated on top of each table or page, with the caption followed by
+    `continued`. `columns`, `where`, `sort_by` and `limit` select the rows
+    and the columns of the csv while it is read, see query.Query
     >>> import csv
     >>> data = [['Name', 'Weight', 'Heigth'],
     ...         ['Pippo', 58.789, 1.828],
     ...         ['Pluto', 16.983, 0.608]]
-    >>> with open('examples/some.csv', 'wb') as f:
+    >>> with open('examples/some.csv', 'w', newline='') as f:
     ...     writer = csv.writer(f)
     ...     writer.writerows(data)
     >>> print(do_table('examples/some.csv', delimiter=',',
@@ -201,10 +830,164 @@ def do_table(
       \\caption{ Weight and height of Pluto and Pippo }
       \\label{ WH }
     \\end{table}
+    >>> print(do_table('examples/some.csv', split_rows=1, caption='Animals'))
+    \\begin{table}[htb!]
+      \\scriptsize 
+      \\centering
+      \\begin{tabular}{ ccc }
+    Name & Weight & Heigth \\\\
+    Pippo & 58.79 & 1.83 \\\\
+      \\end{tabular}
+      \\caption{ Animals }
+    <BLANKLINE>
+    \\end{table}
+    \\begin{table}[htb!]
+      \\scriptsize 
+      \\centering
+      \\begin{tabular}{ ccc }
+    Name & Weight & Heigth \\\\
+    Pluto & 16.98 & 0.61 \\\\
+      \\end{tabular}
+      \\addtocounter{table}{-1}\\caption[]{ Animals (continued) }
+    <BLANKLINE>
+    \\end{table}
     """
     # print 'insert Table from file: ', csvfile
-    data = do_datatab(
-        csvfile, delimiter=delimiter, numberformat=numberformat, add_hline=add_hline
+    csvfile = getpath(csvfile)
+    if mode not in TABLEMODES:
+        raise ValueError(
+            "Table mode must be one of: %s" % ", ".join(sorted(TABLEMODES))
+        )
+    hline = get_line(add_hline)
+    query = Query(columns, where, sort_by, limit, int(header_rows or 0))
+    if isset(stream):
+        data = Stream(
+            stream_rows,
+            csvfile,
+            delimiter,
+            numberformat,
+            hline,
+            col_numberformat=col_numberformat,
+            engine=engine,
+            query=query,
+        )
+    else:
+        csvdata = get_cvsdata(csvfile, delimiter, query)
+        data = iter_rows(
+            csvdata,
+            hline=hline,
+            numberformat=numberformat,
+            col_numberformat=col_numberformat,
+            engine=engine,
+        )
+    column = do_columntab(
+        csvfile,
+        delimiter=delimiter,
+        vline=add_vline,
+        layout=col_layout,
+        default=col_layout_default,
+        columns=columns,
+    )
+    kargs = dict(
+        position=position,
+        more=more,
+        column=column,
+        caption=caption,
+        label=label,
+    )
+
+    def generate():
+        """Split the rows only when the table is written, a stream is
+        read once for each loop over it"""
+        return generate_table(data, mode, split_rows, header_rows, continued, **kargs)
+
+    if isset(stream):
+        return Stream(generate)
+    return "".join(generate())
+
+
+def generate_table(
+    data, mode="table", split_rows=0, header_rows=1, continued="continued", **kargs
+):
+    """Return an iterator over the text of a table, from the lines given
+    by iter_rows. With `split_rows` a table is split in a sequence of
+    tables, a longtable is given to latex in chunks; the first
+    `header_rows` rows are repeated on top of each table or page"""
+    split_rows = int(split_rows or 0)
+    header_rows = int(header_rows or 0)
+    kargs["continued"] = continued
+    if split_rows and mode == "table":
+        head, rest = split_head(data, header_rows)
+        kargs["chunks"] = (
+            "\n".join(head + chunk) for chunk in iter_chunks(rest, split_rows)
+        )
+        return gettemplate("splittable.tex").generate(**kargs)
+    if mode == "longtable" and header_rows > 0:
+        head, rest = split_head(data, header_rows)
+        kargs["head"] = "\n".join(head)
+        data = ("\n" + line if i else line for i, line in enumerate(rest))
+    return gettemplate(TABLEMODES[mode]).generate(
+        data=data, chunksize=split_rows, **kargs
+    )
+
+
+def do_summary(
+    csvfile,
+    group_by="",
+    aggregations="count",
+    where=None,
+    delimiter=",",
+    numberformat="{0:.2f}",
+    position="htb!",
+    add_vline="",
+    add_hline="",
+    col_layout="",
+    col_layout_default="c",
+    label="",
+    caption="",
+    more="\\scriptsize \n  \\centering",
+    col_numberformat="",
+    engine="python",
+):
+    """Return a LaTex table with a summary of a table by group. `group_by`
+    are the columns of the groups, `aggregations` are count, sum, mean, min
+    and max of a column, like 'count, mean(Weight) as Mean weight'. The
+    file is read once, row by row, keeping only the partial results of each
+    group; `where` selects the rows to summarize, see query.Query. The other
+    arguments are the ones of table
+    >>> print(do_summary('examples/some.csv', aggregations='count, max(Weight)',
+    ...                  col_numberformat='0:{0:.0f}', add_hline='1'))
+    \\begin{table}[htb!]
+      \\scriptsize 
+      \\centering
+      \\begin{tabular}{ cc }
+    count & max(Weight) \\\\
+    \\hline
+    2 & 58.79 \\\\
+      \\end{tabular}
+    <BLANKLINE>
+    <BLANKLINE>
+    \\end{table}
+    """
+    csvfile = getpath(csvfile)
+    summary = Summary(group_by, aggregations)
+    query = Query(where=where)
+    columns = None
+    if isbinary(csvfile):
+        names = get_columns(csvfile, delimiter)
+        query.prune(names)
+        columns = summary.prune(names) + [name for name, _, _ in query.where]
+        columns = list(dict.fromkeys(columns))
+    rows = iter_table(csvfile, delimiter, columns)
+    if query:
+        rows = query.apply(rows)
+    summarydata = list(summary.apply(rows))
+    data = iter_rows(
+        summarydata,
+        hline=get_line(add_hline),
+        numberformat=numberformat,
+        col_numberformat=col_numberformat,
+        engine=engine,
     )
     column = do_columntab(
         csvfile,
@@ -212,8 +995,9 @@ def do_table(
         vline=add_vline,
         layout=col_layout,
         default=col_layout_default,
+        columns=summarydata[0],
     )
-    return table.render(
+    return gettemplate("table.tex").render(
         position=position,
         more=more,
         column=column,
@@ -223,17 +1007,119 @@ def do_table(
     )
 
 
-def get_file(path, extension):
+def do_sql(
+    dbfile,
+    sql,
+    params=None,
+    header=True,
+    numberformat="{0:.2f}",
+    position="htb!",
+    add_vline="",
+    add_hline="",
+    col_layout="",
+    col_layout_default="c",
+    label="",
+    caption="",
+    more="\\scriptsize \n  \\centering",
+    mode="table",
+    stream=False,
+    col_numberformat="",
+    engine="python",
+    split_rows=0,
+    continued="continued",
+):
+    """Run a query on a SQLite database and return a LaTex table, `params`
+    are the values of the placeholders of the query, with `header` the
+    first row has the names of the columns. The database is opened read
+    only, the connections are reused by all the calls of the run and the
+    rows are formatted while they are fetched. The other arguments are the
+    ones of table, the header is repeated by `mode='longtable'` and by
+    `split_rows`
+    >>> import sqlite3
+    >>> with sqlite3.connect('examples/some.db') as conn:
+    ...     _ = conn.execute('CREATE TABLE t (Name TEXT, Weight REAL)')
+    ...     _ = conn.executemany('INSERT INTO t VALUES (?, ?)',
+    ...                          [('Pippo', 58.789), ('Pluto', 16.983)])
+    >>> conn.close()
+    >>> print(do_sql('examples/some.db', 'SELECT * FROM t WHERE Weight > ?', [20],
+    ...              add_hline='1,-1', more=''))
+    \\begin{table}[htb!]
+    <BLANKLINE>
+      \\begin{tabular}{ cc }
+    Name & Weight \\\\
+    \\hline
+    Pippo & 58.79 \\\\
+    \\hline
+      \\end{tabular}
+    <BLANKLINE>
+    <BLANKLINE>
+    \\end{table}
+    >>> database.POOL.close(); os.remove('examples/some.db')
+    """
+    dbfile = getpath(dbfile)
+    header = isset(header)
+    if mode not in TABLEMODES:
+        raise ValueError(
+            "Table mode must be one of: %s" % ", ".join(sorted(TABLEMODES))
+        )
+    hline = get_line(add_hline)
+
+    def generate():
+        """Run the query when the table is written"""
+        rows = database.iter_query(dbfile, sql, params)
+        names = next(rows)
+        nrows = None
+        if hline and any(line < 0 for line in hline):
+            nrows = database.count_query(dbfile, sql, params) + header
+        column = do_columntab(
+            dbfile,
+            vline=add_vline,
+            layout=col_layout,
+            default=col_layout_default,
+            columns=[str(i) for i in range(len(names))],
+        )
+        data = iter_rows(
+            chain([names], rows) if header else rows,
+            hline=hline,
+            numberformat=numberformat,
+            nrows=nrows,
+            col_numberformat=col_numberformat,
+            engine=engine,
+        )
+        return generate_table(
+            data,
+            mode,
+            split_rows,
+            int(header),
+            continued,
+            position=position,
+            more=more,
+            column=column,
+            caption=caption,
+            label=label,
+        )
+
+    if isset(stream):
+        return Stream(generate)
+    return "".join(generate())
+
+
+def get_file(path, extension, include=None, exclude=None):
     """Return a list of dictionary with path and name of characterize 
-    by a particular extension"""
+    by a particular extension, sorted by name. The names can be filtered
+    with globs or regular expressions, see dirindex.select
+    >>> [fig['name'] for fig in get_file('examples', ['.tex'], exclude='s*')]
+    ['main', 'parameter']
+    """
     flist = []
-    for filename in os.listdir(path):
+    names = [entry.name for entry in scan(getpath(path)) if entry.isfile]
+    for filename in select(names, include, exclude):
         filepath = os.path.join(path, filename)
-        if os.path.isfile(filepath):
-            name, ext = os.path.splitext(filename)
-            if ext in extension:
-                # It's a figure
-                flist.append({"path": filepath, "name": name})
+        getpath(filepath)
+        name, ext = os.path.splitext(filename)
+        if ext in extension:
+            # It's a figure
+            flist.append({"path": filepath, "name": name})
     return flist
 
 
@@ -241,7 +1127,7 @@ def shape(lis, col):
     """Return a iterator to divide a list in different columns
     >>> shped = shape([0,1,2,3,4,5,6,7,8,9], col=3)
     >>> for row in shped:
-    ...     print row
+    ...     print(row)
     [0, 1, 2]
     [3, 4, 5]
     [6, 7, 8]
@@ -263,26 +1149,47 @@ def do_figure(
     label="",
     extension=[".png", ".pdf", ".jpg"],
     col=2,
+    include=None,
+    exclude=None,
+    dpi=None,
+    fmt=None,
+    textwidth="6in",
+    quality=90,
 ):
     """Return Latex code to include figures
     #>>> fig = 'geostat/es1/scatterogram.pdf'
     #>>> do_figure(fig)   
+
+    The figures of a directory are sorted by name, `include` and
+    `exclude` select them by globs or regular expressions ('re:...').
+    With `dpi` the raster images are resized to the `width` they have
+    in the document, with `fmt` they are converted to png or jpg; the
+    latex code includes the derivatives instead of the original images
     """
-    if os.path.isfile(path):
+    if isfile(getpath(path)):
         # print "insert Figure: ", path
-        return figure.render(
+        fig = path
+        if (dpi or fmt) and _figuredir:
+            fig = get_figures([path], width, dpi, fmt, textwidth, quality)[0]
+        return gettemplate("figure.tex").render(
             position=position,
             more=more,
             width=width,
-            fig=path,
+            fig=fig,
             caption=caption,
             label=label,
         )
     else:
         # print "insert Figure conatined in:", path
-        figulist = get_file(path, extension)
+        figulist = get_file(path, extension, include, exclude)
+        if (dpi or fmt) and _figuredir:
+            figs = get_figures(
+                [f["path"] for f in figulist], width, dpi, fmt, textwidth, quality
+            )
+            for fig, path in zip(figulist, figs):
+                fig["path"] = path
         # import pdb; pdb.set_trace()
-        return subfigure.render(
+        return gettemplate("subfigure.tex").render(
             position=position,
             more=more,
             figulist=shape(figulist, int(col)),
@@ -292,6 +1199,171 @@ def do_figure(
         )
 
 
+def do_plot(
+    csvfile,
+    x=0,
+    y=1,
+    points=1000,
+    method="lttb",
+    delimiter=",",
+    numberformat="{0:.6g}",
+    xlabel="",
+    ylabel="",
+    width="\\textwidth",
+    height="",
+    options="",
+    style="",
+    position="htb!",
+    more="\\centering",
+    caption="",
+    label="",
+    datafile=False,
+):
+    """Return a pgfplots plot of two columns of a table, `x` and `y` by
+    name or by number. A long series is reduced to at most `points` points
+    while the file is read, in a single pass and without counting the rows
+    first, with `method` lttb or minmax, see downsample. With `datafile`
+    and the figures directory the points are written to a .dat file, read
+    by pgfplots, instead of the document
+    >>> print(do_plot('examples/some.csv', x='Weight', y='Heigth'))
+    \\begin{tikzpicture}
+      \\begin{axis}[width=\\textwidth]
+        \\addplot[] coordinates {
+    (58.789,1.828) (16.983,0.608)
+        };
+      \\end{axis}
+    \\end{tikzpicture}
+    """
+    from downsample import downsample, get_points
+
+    path = getpath(csvfile)
+    names = [str(name).strip() for name in get_columns(path, delimiter)]
+    query = Query(header=0)
+    cols = [query.position(names, str(col).strip()) for col in (x, y)]
+    if isbinary(path):
+        rows = iter_table(path, delimiter, [names[col] for col in cols])
+        cols = [0, 1]
+    else:
+        rows = iter_table(path, delimiter)
+    next(rows, None)
+    series = downsample(get_points(rows, *cols), int(points), method)
+    fmt = numberformat.format
+    datapath = None
+    if isset(datafile) and _figuredir:
+        datapath = write_points(
+            path, series, fmt, [x, y, points, method, numberformat, delimiter]
+        )
+        data = ""
+    else:
+        coords = ["({0},{1})".format(fmt(px), fmt(py)) for px, py in series]
+        data = "\n".join(" ".join(line) for line in shape(coords, 8) if line)
+    return gettemplate("plot.tex").render(
+        data=data,
+        datafile=datapath,
+        xlabel=xlabel,
+        ylabel=ylabel,
+        width=width,
+        height=height,
+        options=options,
+        style=style,
+        position=position,
+        more=more,
+        caption=caption,
+        label=label,
+    )
+
+
+def write_points(path, series, fmt, args):
+    """Write the points of a plot into a .dat file of the figures directory,
+    the name depends on the content of the input and on the arguments, an
+    existing file is reused"""
+    from cache import hashinput
+
+    inputs = [hashinput(path), get_version()] + [str(arg) for arg in args]
+    key = hashlib.sha1("\0".join(inputs).encode("utf-8")).hexdigest()
+    target = os.path.join(_figuredir, key[:2], key + ".dat")
+    if os.path.isfile(target):
+        return docpath(target)
+    directory = os.path.dirname(target)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(suffix=".dat", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as fdat:
+            fdat.write("x y\n")
+            for px, py in series:
+                fdat.write("{0} {1}\n".format(fmt(px), fmt(py)))
+        os.replace(tmppath, target)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+    return docpath(target)
+
+
+def get_figures(paths, width, dpi, fmt, textwidth, quality):
+    """Return the paths to include in place of the figures, the derivatives
+    are made only if they are missing"""
+    from images import get_pixels, preprocess
+
+    pixels = get_pixels(width, dpi, textwidth)
+    derived = preprocess(
+        [getpath(path) for path in paths],
+        _figuredir,
+        pixels,
+        fmt,
+        quality,
+        jobs=_figurejobs,
+    )
+    return [path if der is None else docpath(der) for path, der in zip(paths, derived)]
+
+
+def load_document(template):
+    """Return the source of a document to render, by its absolute path,
+    the compiled documents are reused while their file does not change"""
+    if not os.path.isabs(template) or not os.path.isfile(template):
+        return None
+    mtime = os.path.getmtime(template)
+    with open(template, "r") as srcfile:
+        source = srcfile.read()
+
+    def uptodate():
+        try:
+            return os.path.getmtime(template) == mtime
+        except OSError:
+            return False
+
+    return source, template, uptodate
+
+
+def get_document(path):
+    """Return the compiled template of a document
+    >>> get_document('examples/main.tex') is get_document('examples/main.tex')
+    True
+    """
+    return get_environment().get_template(os.path.abspath(path))
+
+
+def setbytecode(path=None):
+    """Keep the compiled documents in a bytecode cache inside `path`, the
+    cache is checked against the hash of the source, without a path only
+    the documents compiled by this process are reused"""
+    global _bytecodedir
+    _bytecodedir = path
+    if _environment is not None:
+        _environment.bytecode_cache = get_bytecode(path)
+
+
+def get_bytecode(path):
+    """Return the bytecode cache of a directory"""
+    if not path:
+        return None
+    import jinja2
+
+    os.makedirs(path, exist_ok=True)
+    # the compiled code depends on the filters too
+    pattern = "__jinja2_%s_" + get_version()[:12] + ".cache"
+    return jinja2.FileSystemBytecodeCache(path, pattern)
+
+
 # ==============================================================
 # load template from directory
 # print '\n\n  filters:',os.getcwd()
@@ -299,21 +1371,76 @@ def do_figure(
 abs_pathtemplate = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
 # print 'where the template is: ', abs_pathtemplate
 
-jinjaloader = jinja2.FileSystemLoader(abs_pathtemplate)
-environment = jinja2.Environment(loader=jinjaloader)
+# the environment and the templates are created the first time that
+# they are used, runs that render nothing never import jinja2
+_environment = None
+_bytecodedir = None
+
+# templates of the table modes
+TABLEMODES = {"table": "table.tex", "longtable": "longtable.tex"}
+# old module attributes, loaded on demand
+TEMPLATES = {
+    "table": "table.tex",
+    "longtable": "longtable.tex",
+    "figure": "figure.tex",
+    "subfigure": "subfigure.tex",
+    "plot": "plot.tex",
+}
+
+
+def get_environment():
+    """Return the jinja environment with the dynlatex filters"""
+    global _environment
+    if _environment is None:
+        with timed("jinja2 import"):
+            import jinja2
+        with timed("environment"):
+            jinjaloader = jinja2.ChoiceLoader(
+                [
+                    jinja2.FunctionLoader(load_document),
+                    jinja2.FileSystemLoader(abs_pathtemplate),
+                ]
+            )
+            environment = jinja2.Environment(
+                loader=jinjaloader, bytecode_cache=get_bytecode(_bytecodedir)
+            )
+
+            # add the new filter
+            environment.filters["datetimeformat"] = datetimeformat
+            environment.filters["datatab"] = runtimefilter(cachedfilter(do_datatab))
+            environment.filters["table"] = runtimefilter(cachedfilter(do_table))
+            environment.filters["summary"] = runtimefilter(cachedfilter(do_summary))
+            environment.filters["sql"] = runtimefilter(
+                cachedfilter(do_sql, inputstate=database.dbstate)
+            )
+            environment.filters["plot"] = runtimefilter(
+                cachedfilter(do_plot, nocache=("datafile",))
+            )
+            environment.filters["figure"] = runtimefilter(
+                cachedfilter(do_figure, nocache=("dpi", "fmt"))
+            )
+        _environment = environment
+    return _environment
+
 
-# add the new filter
-environment.filters["datetimeformat"] = datetimeformat
-environment.filters["datatab"] = do_datatab
-environment.filters["table"] = do_table
-environment.filters["figure"] = do_figure
+def gettemplate(name):
+    """Return one of the templates used by the filters"""
+    environment = get_environment()
+    key = "template " + name
+    if key in startup:
+        return environment.get_template(name)
+    # time only the first load, the compiled template is then reused
+    with timed(key):
+        return environment.get_template(name)
 
-Environment = environment
 
-# instance template
-table = environment.get_template("table.tex")
-figure = environment.get_template("figure.tex")
-subfigure = environment.get_template("subfigure.tex")
+def __getattr__(name):
+    """Create the environment and the templates on demand"""
+    if name in ("Environment", "environment"):
+        return get_environment()
+    if name in TEMPLATES:
+        return gettemplate(TEMPLATES[name])
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 if __name__ == "__main__":
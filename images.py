@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Derivatives of the figures, resized and converted for the document.
+
+The raster images are resized to the width they have in the document at
+the requested resolution, and optionally converted to another format.
+The derivatives are stored in a content addressed directory, named after
+the hash of the image and of the options, so an unchanged image is never
+processed again. Pillow is needed only when a derivative is made.
+"""
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import hashinput
+from dirindex import makedir
+
+# the images that can be resized, the vector images are left as they are
+RASTER = (".png", ".jpg", ".jpeg", ".gif", ".tif", ".tiff", ".bmp")
+# formats of the derivatives: Pillow format and extension
+FORMATS = {"png": ("PNG", ".png"), "jpg": ("JPEG", ".jpg"), "jpeg": ("JPEG", ".jpg")}
+# inches of the latex units
+UNITS = {
+    "in": 1.0,
+    "cm": 1 / 2.54,
+    "mm": 1 / 25.4,
+    "pt": 1 / 72.27,
+    "bp": 1 / 72.0,
+    "pc": 12 / 72.27,
+}
+# lengths relative to the width of the text
+TEXTWIDTHS = ("\\textwidth", "\\linewidth", "\\columnwidth")
+# change it when the derivatives are made in a different way
+VERSION = "1"
+
+_width = re.compile(r"(?:^|,)\s*width\s*=\s*([0-9.]*)\s*(\\?[a-z]+)", re.IGNORECASE)
+
+
+def get_pil():
+    """Return the Image module of Pillow, needed only to make derivatives"""
+    from filters import timed
+
+    try:
+        with timed("Pillow import"):
+            from PIL import Image
+    except ImportError:
+        raise ImportError(
+            "The figure pipeline requires Pillow, try: pip install Pillow"
+        )
+    return Image
+
+
+def get_length(length, textwidth="6in"):
+    """Return a latex length in inches, None if it is not understood
+    >>> get_length('8cm') == 8 / 2.54
+    True
+    >>> get_length('0.5\\\\textwidth'), get_length('0.5\\\\textwidth', '5in')
+    (3.0, 2.5)
+    >>> get_length('1em') is None
+    True
+    """
+    match = re.match(r"\s*([0-9.]*)\s*(\\?[a-z]+)\s*$", str(length), re.IGNORECASE)
+    if not match:
+        return None
+    number, unit = match.groups()
+    try:
+        number = float(number) if number else 1.0
+    except ValueError:
+        return None
+    if unit in TEXTWIDTHS:
+        base = get_length(textwidth)
+        return None if base is None else number * base
+    if unit.lower() in UNITS:
+        return number * UNITS[unit.lower()]
+    return None
+
+
+def get_pixels(width, dpi, textwidth="6in"):
+    """Return the width in pixels of a figure, from the options of
+    includegraphics, None if the options do not set a width
+    >>> get_pixels('width=0.5\\\\textwidth', 200)
+    600
+    >>> get_pixels('angle=90, width=2in', 150)
+    300
+    >>> get_pixels(1, 150) is None
+    True
+    """
+    if not dpi:
+        return None
+    match = _width.search(str(width))
+    if not match:
+        return None
+    inches = get_length("".join(match.groups()), textwidth)
+    if inches is None:
+        return None
+    return int(round(inches * float(dpi)))
+
+
+def get_derivative(path, figuredir, pixels=None, fmt=None, quality=90):
+    """Return the path of the derivative of an image, None if the image is
+    used as it is. The name depends on the content of the image and on
+    the options, not on the path"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in RASTER or not (pixels or fmt):
+        return None
+    if fmt:
+        fmt = str(fmt).lower().lstrip(".")
+        if fmt not in FORMATS:
+            raise ValueError(
+                "Unknown figure format %r, use one of: %s"
+                % (fmt, ", ".join(sorted(FORMATS)))
+            )
+        ext = FORMATS[fmt][1]
+    inputs = [hashinput(path), str(pixels), str(fmt), str(quality), VERSION]
+    key = hashlib.sha1("\0".join(inputs).encode("utf-8")).hexdigest()
+    return os.path.join(figuredir, key[:2], key + ext)
+
+
+def make_derivative(path, target, pixels=None, fmt=None, quality=90):
+    """Write the derivative of an image into `target`, the images are
+    never enlarged"""
+    Image = get_pil()
+    directory = os.path.dirname(target)
+    makedir(directory)
+    fd, tmppath = tempfile.mkstemp(suffix=os.path.splitext(target)[1], dir=directory)
+    os.close(fd)
+    try:
+        with Image.open(path) as img:
+            form = FORMATS[fmt.lower().lstrip(".")][0] if fmt else img.format
+            if (not pixels or img.width <= pixels) and form == img.format:
+                # nothing to do, use a copy to keep the name
+                shutil.copyfile(path, tmppath)
+            else:
+                if pixels and img.width > pixels:
+                    height = max(int(round(img.height * pixels / img.width)), 1)
+                    img = img.resize((pixels, height), Image.LANCZOS)
+                if form == "JPEG" and img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                options = {"quality": int(quality)} if form == "JPEG" else {}
+                img.save(tmppath, form, **options)
+        os.replace(tmppath, target)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+    return target
+
+
+def _make(args):
+    """Make a derivative in a worker thread"""
+    return make_derivative(*args)
+
+
+def preprocess(paths, figuredir, pixels=None, fmt=None, quality=90, jobs=None):
+    """Return the derivative of each image, or None for the images used as
+    they are. The missing derivatives are made on `jobs` threads, all the
+    processors by default: Pillow releases the GIL while it decodes,
+    resizes and encodes, and a pool of processes inside each job of a
+    parallel build would start jobs times the processors
+    >>> preprocess(['examples/some.csv'], 'build/.dyncache/figures', pixels=100)
+    [None]
+    """
+    targets = [get_derivative(path, figuredir, pixels, fmt, quality) for path in paths]
+    missing = {}
+    for path, target in zip(paths, targets):
+        if target and target not in missing and not os.path.isfile(target):
+            missing[target] = (path, target, pixels, fmt, quality)
+    jobs = jobs or os.cpu_count() or 1
+    if len(missing) > 1 and jobs > 1:
+        with ThreadPoolExecutor(max_workers=min(jobs, len(missing))) as pool:
+            list(pool.map(_make, missing.values()))
+    else:
+        for args in missing.values():
+            make_derivative(*args)
+    return targets
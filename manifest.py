@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Manifest of the rendered files, used by the incremental builds.
+
+For each output file the manifest records the template, the files and
+directories read by the filters, the configuration sections used by the
+template and the version of the filters. A template is rendered again
+only if one of them is changed.
+"""
+import hashlib
+import json
+import os
+
+import filters
+from cache import get_version
+
+MANIFEST = ".dynmanifest.json"
+
+
+def hashfile(path):
+    """Return the sha1 of the content of a file"""
+    with open(path, "rb") as fil:
+        return hashlib.sha1(fil.read()).hexdigest()
+
+
+def hashvalue(value):
+    """Return the sha1 of a configuration value
+    >>> hashvalue({'b': 1, 'a': 2}) == hashvalue({'a': 2, 'b': 1})
+    True
+    """
+    dump = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha1(dump.encode("utf-8")).hexdigest()
+
+
+def getstat(path):
+    """Return modification time and size of a file, None if it is missing"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def get_sections(source):
+    """Return the names that a template takes from the configuration
+    >>> get_sections("{{ info.name }} {{ 'a.csv'|table(**euro) }}")
+    ['euro', 'info']
+    """
+    from jinja2 import meta
+
+    environment = filters.get_environment()
+    return sorted(meta.find_undeclared_variables(environment.parse(source)))
+
+
+class Manifest:
+    """The manifest of a destination directory
+    >>> man = Manifest('build')
+    >>> man.uptodate('examples/simple.tex', 'build/simple.tex', {})
+    False
+    """
+
+    def __init__(self, dest):
+        self.path = os.path.join(dest, MANIFEST)
+        self.outputs = {}
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as fman:
+                data = json.load(fman)
+            # a different version of the filters could render differently
+            if data.get("version") == get_version():
+                self.outputs = data.get("outputs", {})
+
+    def uptodate(self, _src, output, kargs):
+        """Return True if the output exists and none of its inputs changed"""
+        entry = self.outputs.get(os.path.normpath(output))
+        if entry is None or not os.path.isfile(output):
+            return False
+        path, tstat, thash = entry["template"]
+        if path != os.path.abspath(_src):
+            return False
+        if getstat(_src) != tstat:
+            # touched but maybe not changed
+            if not os.path.isfile(_src) or hashfile(_src) != thash:
+                return False
+        for dep, dstat in entry["deps"].items():
+            if getstat(dep) != dstat:
+                return False
+        for sec, shash in entry["config"].items():
+            if hashvalue(kargs.get(sec)) != shash:
+                return False
+        return True
+
+    def record(self, _src, output, kargs, deps, sections, outhash=None):
+        """Record the inputs of a rendered file, `deps` is a dictionary with
+        the state of the files read by the filters"""
+        self.outputs[os.path.normpath(output)] = {
+            "output": outhash,
+            "template": [os.path.abspath(_src), getstat(_src), hashfile(_src)],
+            "deps": deps,
+            "config": {sec: hashvalue(kargs.get(sec)) for sec in sections},
+        }
+
+    def hashes(self):
+        """Return the hash of each rendered file"""
+        return {out: entry.get("output") for out, entry in self.outputs.items()}
+
+    def inputs(self):
+        """Return the templates and the files read by the filters"""
+        paths = set()
+        for entry in self.outputs.values():
+            paths.add(entry["template"][0])
+            paths.update(entry["deps"])
+        return sorted(paths)
+
+    def save(self):
+        """Write the manifest into the destination directory"""
+        os.makedirs(os.path.dirname(self.path) or os.curdir, exist_ok=True)
+        with open(self.path, "w") as fman:
+            json.dump(
+                {"version": get_version(), "outputs": self.outputs},
+                fman,
+                indent=1,
+                sort_keys=True,
+            )
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the builds.
+
+While the profiler is enabled, the spans record the wall time and some
+counters (bytes, rows, cache hits and misses) of the rendered templates,
+of the copies and of the filter calls. The spans are summarized sorted by
+cost, and can be saved as JSON or as a Chrome trace, to be opened in
+chrome://tracing or Perfetto. When the profiler is disabled a span costs
+only a function call.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# counters of the innermost open span
+_current = ContextVar("span", default=None)
+# counters shown in the summary
+COUNTERS = ("bytes", "rows", "hits", "misses")
+FORMATS = ("json", "trace")
+# columns of the printed summary
+HEADER = "  {0:<8} {1:<40} {2:>6} {3:>10} {4:>10} {5:>8} {6:>6} {7:>6}"
+LINE = "  {0:<8} {1:<40} {2:>6} {3:>10.1f} {4:>10} {5:>8} {6:>6} {7:>6}"
+
+
+class Profiler:
+    """Collect the spans of a build
+    >>> prof = Profiler()
+    >>> prof.enabled = True
+    >>> with prof.span('filter', 'table some.csv'):
+    ...     prof.count('rows', 3)
+    >>> with prof.span('filter', 'table some.csv'):
+    ...     prof.count('rows', 2)
+    >>> [(row['name'], row['calls'], row['rows']) for row in prof.summary()]
+    [('table some.csv', 2, 5)]
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, cat, name, **args):
+        """Record the time spent in the block, the counters of the block
+        are kept in `args`"""
+        if not self.enabled:
+            yield args
+            return
+        token = _current.set(args)
+        start = time.time()
+        try:
+            yield args
+        finally:
+            end = time.time()
+            _current.reset(token)
+            event = {
+                "cat": cat,
+                "name": name,
+                "ts": start,
+                "dur": end - start,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def count(self, key, value=1):
+        """Add `value` to a counter of the innermost span"""
+        args = _current.get()
+        if args is not None:
+            args[key] = args.get(key, 0) + value
+
+    def collect(self):
+        """Return the events recorded by this process and forget them, used
+        to send the events of a worker to the main process. A forked worker
+        starts with a copy of the events of its parent, they are left"""
+        pid = os.getpid()
+        with self._lock:
+            events = [event for event in self.events if event["pid"] == pid]
+            self.events = [event for event in self.events if event["pid"] != pid]
+        return events
+
+    def merge(self, events):
+        """Add the events recorded by another process"""
+        with self._lock:
+            self.events.extend(events)
+
+    def summary(self):
+        """Return the spans grouped by category and name, sorted by time"""
+        rows = {}
+        for event in self.events:
+            key = (event["cat"], event["name"])
+            row = rows.get(key)
+            if row is None:
+                row = {"cat": event["cat"], "name": event["name"], "calls": 0}
+                row["seconds"] = 0.0
+                row.update((counter, 0) for counter in COUNTERS)
+                rows[key] = row
+            row["calls"] += 1
+            row["seconds"] += event["dur"]
+            for counter in COUNTERS:
+                row[counter] += event["args"].get(counter, 0)
+        return sorted(rows.values(), key=lambda row: -row["seconds"])
+
+    def report(self, limit=20):
+        """Print the most expensive spans"""
+        rows = self.summary()
+        print("Build profile, sorted by time:")
+        print(
+            HEADER.format(
+                "kind", "name", "calls", "ms", "bytes", "rows", "hits", "misses"
+            )
+        )
+        for row in rows[:limit]:
+            name = row["name"]
+            if len(name) > 40:
+                name = "..." + name[-37:]
+            print(
+                LINE.format(
+                    row["cat"],
+                    name,
+                    row["calls"],
+                    row["seconds"] * 1000,
+                    row["bytes"],
+                    row["rows"],
+                    row["hits"],
+                    row["misses"],
+                )
+            )
+        if len(rows) > limit:
+            print("  ... {0} more".format(len(rows) - limit))
+
+    def save(self, path, fmt="json"):
+        """Write the spans into a file, as json with the summary and the
+        events or as a Chrome trace"""
+        if fmt not in FORMATS:
+            raise ValueError("Profile format must be one of: %s" % ", ".join(FORMATS))
+        start = min([event["ts"] for event in self.events] or [0])
+        if fmt == "trace":
+            data = {
+                "traceEvents": [
+                    {
+                        "name": event["name"],
+                        "cat": event["cat"],
+                        "ph": "X",
+                        "ts": round((event["ts"] - start) * 1e6, 1),
+                        "dur": round(event["dur"] * 1e6, 1),
+                        "pid": event["pid"],
+                        "tid": event["tid"],
+                        "args": event["args"],
+                    }
+                    for event in self.events
+                ],
+                "displayTimeUnit": "ms",
+            }
+        else:
+            data = {"summary": self.summary(), "events": self.events}
+        with open(path, "w") as fprof:
+            json.dump(data, fprof, indent=1, default=str)
+
+
+PROFILE = Profiler()
+
+
+def enabled():
+    """Return True if the spans are recorded"""
+    return PROFILE.enabled
+
+
+def span(cat, name, **args):
+    """Record a span in the shared profiler"""
+    return PROFILE.span(cat, name, **args)
+
+
+def count(key, value=1):
+    """Add to a counter of the innermost span of the shared profiler"""
+    PROFILE.count(key, value)
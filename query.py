@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Select the rows and the columns of a table while the rows are read.
+
+A query keeps only the rows that satisfy some conditions (`where`),
+sorts them (`sort_by`), keeps the first rows (`limit`) and the requested
+columns (`columns`). The header rows are never filtered nor sorted. With
+a limit the sorted rows are kept in a heap of `limit` rows, so the work
+and the memory depend on the rows shown and not on the size of the file.
+On a parsed table the keys of the columns are computed once and shared by
+all the queries on the same file.
+
+The rows can also be summarized by group in a single pass, keeping only
+a few numbers for each group.
+"""
+import heapq
+import operator
+import re
+from itertools import islice
+
+from tables import sortkey
+
+OPERATORS = {
+    "==": operator.eq,
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<=": operator.le,
+    ">=": operator.ge,
+    "<": operator.lt,
+    ">": operator.gt,
+}
+
+_condition = re.compile(r"^\s*(.+?)\s*(==|!=|<=|>=|=|<|>)\s*(.*?)\s*$")
+_aggregation = re.compile(r"^\s*(\w+)\s*(?:\(\s*(.*?)\s*\))?\s*(?:\bas\s+(.+?))?\s*$")
+# aggregations of the summaries
+AGGREGATIONS = ("count", "sum", "mean", "min", "max")
+
+
+def get_names(names):
+    """Return a list of column names, separated by ','
+    >>> get_names('Name, Weight'), get_names(None), get_names([0, 2])
+    (['Name', 'Weight'], [], ['0', '2'])
+    """
+    if not names:
+        return []
+    if isinstance(names, str):
+        names = names.split(",")
+    return [str(name).strip() for name in names if str(name).strip()]
+
+
+def get_conditions(where):
+    """Return the conditions as (column, operator, key of the value), the
+    conditions are separated by ';', quote the strings that look like numbers
+    >>> get_conditions("Weight > 10; Name != 'Pluto'")
+    [('Weight', '>', (0, 10.0)), ('Name', '!=', (1, 'Pluto'))]
+    """
+    if not where:
+        return []
+    if isinstance(where, str):
+        where = where.split(";")
+    conditions = []
+    for cond in where:
+        if not cond.strip():
+            continue
+        match = _condition.match(cond)
+        if not match:
+            raise ValueError(
+                "Condition %r not understood, use: column op value, with op "
+                "one of: %s" % (cond, " ".join(sorted(OPERATORS)))
+            )
+        name, oper, value = match.groups()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in "'\"":
+            value = (1, value[1:-1])
+        else:
+            value = sortkey(value)
+        conditions.append((name, oper, value))
+    return conditions
+
+
+def compare(key, oper, value):
+    """Return True if a cell satisfies a condition, a number and a string
+    are only different
+    >>> compare((0, 58.8), '>', (0, 10.0)), compare((1, 'n/a'), '>', (0, 10.0))
+    (True, False)
+    """
+    if key[0] != value[0]:
+        return oper == "!="
+    return OPERATORS[oper](key[1], value[1])
+
+
+class Reverse:
+    """Sort key in descending order"""
+
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+class Query:
+    """Columns, conditions, order and number of the rows of a table
+    >>> rows = [['Name', 'Weight'], ['Pippo', '58.8'], ['Pluto', '17.0'],
+    ...         ['Paperino', '3']]
+    >>> list(Query(columns='Name', where='Weight > 10', sort_by='Weight').apply(rows))
+    [['Name'], ['Pluto'], ['Pippo']]
+    >>> list(Query(sort_by='-Weight', limit=2).apply(rows))
+    [['Name', 'Weight'], ['Pippo', '58.8'], ['Pluto', '17.0']]
+    >>> list(Query(columns='1, 0', limit=1).apply(rows))
+    [['Weight', 'Name'], ['58.8', 'Pippo']]
+    >>> bool(Query())
+    False
+    """
+
+    def __init__(self, columns=None, where=None, sort_by=None, limit=None, header=1):
+        self.columns = get_names(columns)
+        self.where = get_conditions(where)
+        self.sort_by = [
+            (name[1:].strip(), True) if name.startswith("-") else (name, False)
+            for name in get_names(sort_by)
+        ]
+        self.limit = None if limit in (None, "") else int(limit)
+        self.header = int(header)
+
+    def __bool__(self):
+        return bool(self.columns or self.where or self.sort_by) or (
+            self.limit is not None
+        )
+
+    def position(self, names, name):
+        """Return the position of a column, by name or by number"""
+        if name in names:
+            return names.index(name)
+        try:
+            return int(name)
+        except ValueError:
+            raise ValueError(
+                "Unknown column %r, the columns are: %s" % (name, ", ".join(names))
+            )
+
+    def prune(self, names):
+        """Refer to the columns by name, return the names of the columns
+        needed by the query, None if all the columns are shown
+        >>> query = Query(columns='0', where='Weight > 1', sort_by='-Name')
+        >>> query.prune(['Name', 'Weight', 'Heigth'])
+        ['Name', 'Weight']
+        >>> query.columns, query.sort_by
+        (['Name'], [('Name', True)])
+        """
+        names = [str(name).strip() for name in names]
+        self.columns = [names[self.position(names, name)] for name in self.columns]
+        self.where = [
+            (names[self.position(names, name)], oper, value)
+            for name, oper, value in self.where
+        ]
+        self.sort_by = [
+            (names[self.position(names, name)], desc) for name, desc in self.sort_by
+        ]
+        if not self.columns:
+            return None
+        needed = self.columns + [name for name, _, _ in self.where]
+        needed += [name for name, _ in self.sort_by]
+        return list(dict.fromkeys(needed))
+
+    def apply(self, rows, table=None):
+        """Return an iterator over the selected rows, with a parsed `table`
+        the keys of its columns are reused"""
+        rows = iter(rows)
+        head = list(islice(rows, self.header))
+        names = [str(name).strip() for name in head[0]] if head else []
+        conditions = [
+            (self.position(names, name), oper, value)
+            for name, oper, value in self.where
+        ]
+        order = [(self.position(names, name), desc) for name, desc in self.sort_by]
+        cols = [self.position(names, name) for name in self.columns]
+
+        def getkey(i, row, col):
+            if table is not None:
+                return table.keys(col)[i]
+            return sortkey(row[col]) if col < len(row) else (1, "")
+
+        selected = (
+            (i, row)
+            for i, row in enumerate(rows, len(head))
+            if all(
+                compare(getkey(i, row, col), oper, value)
+                for col, oper, value in conditions
+            )
+        )
+        if order:
+
+            def rank(item):
+                i, row = item
+                return tuple(
+                    Reverse(getkey(i, row, col)) if desc else getkey(i, row, col)
+                    for col, desc in order
+                )
+
+            if self.limit is not None:
+                selected = heapq.nsmallest(self.limit, selected, key=rank)
+            else:
+                selected = sorted(selected, key=rank)
+        elif self.limit is not None:
+            selected = islice(selected, self.limit)
+        for row in head:
+            yield self.project(row, cols)
+        for _, row in selected:
+            yield self.project(row, cols)
+
+    def project(self, row, cols):
+        """Return only the selected columns of a row"""
+        if not cols:
+            return row
+        return [row[col] if col < len(row) else "" for col in cols]
+
+
+def get_aggregations(aggregations):
+    """Return the aggregations as (function, column, label), separated by
+    ','. The label is the header of the column in the summary, None for
+    the default one
+    >>> get_aggregations('count, mean(Weight) as Mean weight')
+    [('count', None, None), ('mean', 'Weight', 'Mean weight')]
+    """
+    if isinstance(aggregations, str):
+        aggregations = aggregations.split(",")
+    result = []
+    for agg in aggregations:
+        if not agg.strip():
+            continue
+        match = _aggregation.match(agg)
+        if not match or match.group(1).lower() not in AGGREGATIONS:
+            raise ValueError(
+                "Aggregation %r not understood, use: function(column) [as label],"
+                " with function one of: %s" % (agg, ", ".join(AGGREGATIONS))
+            )
+        func, column, label = match.groups()
+        func = func.lower()
+        if func != "count" and not column:
+            raise ValueError("Aggregation %r needs a column" % agg)
+        result.append((func, column or None, label))
+    return result
+
+
+class Summary:
+    """Aggregations of the rows of a table by group, computed in a single
+    pass: each group keeps a count, a sum, a minimum and a maximum for each
+    aggregation. The values that are not numbers are counted by count only
+    >>> rows = [['Kind', 'Weight'], ['dog', '58.8'], ['dog', '17.0'],
+    ...         ['duck', '3'], ['duck', 'n/a']]
+    >>> summary = Summary('Kind', 'count, mean(Weight), max(Weight)')
+    >>> for row in summary.apply(rows):
+    ...     print(row)
+    ['Kind', 'count', 'mean(Weight)', 'max(Weight)']
+    ['dog', 2, 37.9, 58.8]
+    ['duck', 2, 3.0, 3.0]
+    >>> list(Summary('', 'min(Weight)').apply(rows))
+    [['min(Weight)'], [3.0]]
+    """
+
+    def __init__(self, group_by, aggregations, header=1):
+        self.group_by = get_names(group_by)
+        self.aggregations = get_aggregations(aggregations)
+        self.header = max(int(header), 1)
+
+    def prune(self, names):
+        """Refer to the columns by name, return the names of the columns
+        needed by the summary"""
+        names = [str(name).strip() for name in names]
+        query = Query(header=0)
+        self.group_by = [names[query.position(names, name)] for name in self.group_by]
+        self.aggregations = [
+            (func, None if col is None else names[query.position(names, col)], label)
+            for func, col, label in self.aggregations
+        ]
+        cols = self.group_by + [col for _, col, _ in self.aggregations if col]
+        return list(dict.fromkeys(cols))
+
+    def apply(self, rows):
+        """Return the header and the rows of the summary, one for each
+        group sorted by group"""
+        rows = iter(rows)
+        head = list(islice(rows, self.header))
+        names = [str(name).strip() for name in head[0]] if head else []
+        query = Query(header=0)
+        groups = [query.position(names, name) for name in self.group_by]
+        aggs = [
+            (func, None if col is None else query.position(names, col))
+            for func, col, _ in self.aggregations
+        ]
+        # group -> [count, sum, min, max] for each aggregation
+        states = {}
+        for row in rows:
+            key = tuple(row[col] if col < len(row) else "" for col in groups)
+            state = states.get(key)
+            if state is None:
+                state = states[key] = [[0, 0.0, None, None] for _ in aggs]
+            for acc, (func, col) in zip(state, aggs):
+                if col is None:
+                    acc[0] += 1
+                    continue
+                cell = row[col] if col < len(row) else ""
+                if func == "count":
+                    acc[0] += cell not in ("", None)
+                    continue
+                kind, value = sortkey(cell)
+                if kind:
+                    continue
+                acc[0] += 1
+                acc[1] += value
+                if acc[2] is None or value < acc[2]:
+                    acc[2] = value
+                if acc[3] is None or value > acc[3]:
+                    acc[3] = value
+        if not groups and not states:
+            # a summary of no rows is still a row
+            states[()] = [[0, 0.0, None, None] for _ in aggs]
+        labels = [
+            label or ("{0}({1})".format(func, col) if col else func)
+            for func, col, label in self.aggregations
+        ]
+        yield [names[col] for col in groups] + labels
+        for key in sorted(states, key=lambda key: [sortkey(cell) for cell in key]):
+            yield list(key) + [
+                result(func, acc) for acc, (func, _) in zip(states[key], aggs)
+            ]
+
+
+def result(func, acc):
+    """Return the result of an aggregation from its count, sum, min and max"""
+    count, total, low, high = acc
+    if func == "count":
+        return count
+    if not count:
+        return ""
+    if func == "sum":
+        return total
+    if func == "mean":
+        return total / count
+    return low if func == "min" else high
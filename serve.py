@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Long running render server.
+
+The server keeps a warm process: the jinja environment, the compiled
+templates and the caches of the tables and of the filters survive from a
+request to the next one, and are invalidated by the modification times of
+the files. The requests are JSON posted to an HTTP server on localhost or
+on a Unix socket:
+
+    POST /render  {"template": "report/main.tex", "context": {"info.name": "A"}}
+    POST /build   {"sources": ["report/"], "dest": "build/a", "context": {}}
+    GET  /status
+
+At most `workers` requests run at the same time and at most `queue`
+others wait for a worker, the next ones are refused at once with the
+status 503, so a client knows it has to slow down.
+"""
+import json
+import math
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# requests running at the same time, and waiting for a worker
+WORKERS = 4
+QUEUE = 16
+# latencies kept for each kind of request
+SAMPLES = 1000
+# biggest request accepted, in bytes
+MAXBODY = 16 * 1024 * 1024
+
+
+class Busy(Exception):
+    """The queue of the server is full"""
+
+
+def percentile(values, pct):
+    """Return a percentile of a list of values, by nearest rank
+    >>> percentile([4, 1, 3, 2], 50), percentile([4, 1, 3, 2], 99)
+    (2, 4)
+    >>> percentile([], 50) is None
+    True
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(math.ceil(pct / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+class Stats:
+    """Count the requests and keep their latest latencies
+    >>> stats = Stats()
+    >>> for ms in range(1, 101):
+    ...     stats.record('render', ms / 1000.0, True)
+    >>> stats.record('render', 0.5, False)
+    >>> summary = stats.summary()['render']
+    >>> summary['requests'], summary['errors'], summary['p50'], summary['p99']
+    (101, 1, 51.0, 100.0)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.requests = {}
+        self.errors = {}
+
+    def record(self, name, seconds, ok):
+        """Record a request"""
+        with self._lock:
+            self.latencies.setdefault(name, deque(maxlen=SAMPLES)).append(seconds)
+            self.requests[name] = self.requests.get(name, 0) + 1
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summary(self):
+        """Return for each kind of request the count, the errors and the
+        percentiles of the latency in milliseconds"""
+        with self._lock:
+            latencies = {name: list(values) for name, values in self.latencies.items()}
+            requests = dict(self.requests)
+            errors = dict(self.errors)
+        summary = {}
+        for name, values in latencies.items():
+            row = {"requests": requests[name], "errors": errors.get(name, 0)}
+            for pct in (50, 90, 99):
+                row["p%d" % pct] = round(percentile(values, pct) * 1000, 3)
+            row["max"] = round(max(values) * 1000, 3)
+            summary[name] = row
+        return summary
+
+
+class Service:
+    """The handlers of the requests, run on a bounded number of workers
+    with a bounded queue. `handlers` are functions that take the posted
+    JSON and return a JSON value, `caches` a function that returns the
+    state of the caches for the status
+    >>> service = Service({'echo': lambda payload: payload}, workers=1, queue=0)
+    >>> service.call('echo', {'a': 1})
+    {'a': 1}
+    >>> service.status()['latency']['echo']['requests']
+    1
+    """
+
+    def __init__(self, handlers, workers=WORKERS, queue=QUEUE, caches=None):
+        self.handlers = handlers
+        self.workers = max(int(workers), 1)
+        self.queue = max(int(queue), 0)
+        self.caches = caches
+        self.stats = Stats()
+        self.started = time.time()
+        self.active = 0
+        self.waiting = 0
+        self.refused = 0
+        self._admit = threading.BoundedSemaphore(self.workers + self.queue)
+        self._run = threading.Semaphore(self.workers)
+        self._lock = threading.Lock()
+
+    def call(self, name, payload):
+        """Run a request, raise Busy if all the workers are busy and the
+        queue is full"""
+        if not self._admit.acquire(blocking=False):
+            with self._lock:
+                self.refused += 1
+            raise Busy("The server is busy, try again later")
+        try:
+            with self._lock:
+                self.waiting += 1
+            with self._run:
+                with self._lock:
+                    self.waiting -= 1
+                    self.active += 1
+                start = time.perf_counter()
+                ok = False
+                try:
+                    result = self.handlers[name](payload)
+                    ok = True
+                finally:
+                    with self._lock:
+                        self.active -= 1
+                    self.stats.record(name, time.perf_counter() - start, ok)
+            return result
+        finally:
+            self._admit.release()
+
+    def status(self):
+        """Return the state of the server"""
+        with self._lock:
+            status = {
+                "uptime": round(time.time() - self.started, 3),
+                "workers": self.workers,
+                "queue": self.queue,
+                "active": self.active,
+                "waiting": self.waiting,
+                "refused": self.refused,
+            }
+        status["latency"] = self.stats.summary()
+        status["caches"] = self.caches() if self.caches else {}
+        return status
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Translate the HTTP requests into calls of the service"""
+
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, code, data, headers=()):
+        """Send a JSON response"""
+        body = json.dumps(data, default=str).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/status":
+            self.reply(200, self.server.service.status())
+        else:
+            self.reply(404, {"error": "Unknown path %s" % self.path})
+
+    def do_POST(self):
+        service = self.server.service
+        name = self.path.strip("/")
+        length = int(self.headers.get("Content-Length") or 0)
+        if name not in service.handlers:
+            self.rfile.read(length)
+            self.reply(404, {"error": "Unknown path %s" % self.path})
+            return
+        if length > MAXBODY:
+            self.close_connection = True
+            self.reply(413, {"error": "Request too big"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as err:
+            self.reply(400, {"error": "Not a JSON request: %s" % err})
+            return
+        try:
+            result = service.call(name, payload)
+        except Busy as err:
+            self.reply(503, {"error": str(err)}, [("Retry-After", "1")])
+        except Exception as err:
+            self.reply(500, {"error": "%s: %s" % (type(err).__name__, err)})
+        else:
+            self.reply(200, result)
+
+    def address_string(self):
+        # the clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket"""
+
+    daemon_threads = True
+
+
+def make_server(address, service, verbose=False):
+    """Return a server listening on `address`: host:port, :port for
+    localhost, or the path of a Unix socket"""
+    if ":" in address and os.sep not in address:
+        host, port = address.rsplit(":", 1)
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+        server.daemon_threads = True
+    else:
+        if os.path.exists(address):
+            # a socket left by a server that did not stop cleanly
+            os.remove(address)
+        server = UnixHTTPServer(address, Handler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def serve(address, service, verbose=False):
+    """Serve the requests until the process is interrupted or terminated"""
+    server = make_server(address, service, verbose)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Serving on {0}, stop with Ctrl-C".format(address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(server, UnixHTTPServer) and os.path.exists(address):
+            os.remove(address)
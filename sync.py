@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Mirror the assets, the files that are not templates, into the build.
+
+The whole mirror is planned first: the files already up to date (same
+size and modification time, or same content with `checksum`) are
+skipped, the assets mirrored by the previous run and now missing from the
+sources are removed. Then the copies run in bulk on a pool of threads.
+A copy is a copy-on-write clone (reflink) or a hard link when the
+filesystem allows it, a byte copy otherwise.
+"""
+import errno
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import profiler
+from dirindex import INDEX
+
+# state of the last mirror, inside the destination directory
+ASSETS = ".dynassets.json"
+# how the assets are mirrored, auto tries reflink, then hardlink, then copy
+MODES = ("auto", "reflink", "hardlink", "copy", "symlink")
+# threads used for the copies
+THREADS = 8
+# ioctl that clones a file on linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# filesystems that do not support a way of copying: (mode, src, dst device)
+_unsupported = set()
+
+
+def hashfile(path):
+    """Return the sha1 of the content of a file"""
+    sha = hashlib.sha1()
+    with open(path, "rb") as fil:
+        for block in iter(lambda: fil.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def uptodate(_src, _dst, mode="auto", checksum=False):
+    """Return True if the mirror of a file is up to date
+    >>> import shutil
+    >>> shutil.copy2('examples/copy.txt', 'examples/copy_sync.txt')
+    'examples/copy_sync.txt'
+    >>> uptodate('examples/copy.txt', 'examples/copy_sync.txt')
+    True
+    >>> uptodate('examples/copy.txt', 'examples/copy_sync.txt', 'symlink')
+    False
+    >>> os.utime('examples/copy_sync.txt', (0, 0))
+    >>> uptodate('examples/copy.txt', 'examples/copy_sync.txt')
+    False
+    >>> uptodate('examples/copy.txt', 'examples/copy_sync.txt', checksum=True)
+    True
+    >>> os.remove('examples/copy_sync.txt')
+    """
+    if mode == "symlink":
+        return os.path.islink(_dst) and os.readlink(_dst) == _src
+    try:
+        if os.path.islink(_dst):
+            return False
+        src, dst = os.stat(_src), os.stat(_dst)
+    except OSError:
+        return False
+    if (src.st_dev, src.st_ino) == (dst.st_dev, dst.st_ino):
+        # a hard link
+        return True
+    if src.st_size != dst.st_size:
+        return False
+    if src.st_mtime_ns == dst.st_mtime_ns:
+        return True
+    return checksum and hashfile(_src) == hashfile(_dst)
+
+
+def reflink(_src, _dst):
+    """Clone a file sharing its blocks, raise OSError if not supported"""
+    import fcntl
+
+    with open(_src, "rb") as fsrc, open(_dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(_src, _dst)
+
+
+def hardlink(_src, _dst):
+    """Make a hard link to a file"""
+    os.link(_src, _dst)
+
+
+def bytecopy(_src, _dst):
+    """Copy the content, the permissions and the times of a file"""
+    shutil.copy2(_src, _dst)
+
+
+def symlink(_src, _dst):
+    """Make a symbolic link to a file"""
+    os.symlink(_src, _dst)
+
+
+COPIES = {
+    "reflink": reflink,
+    "hardlink": hardlink,
+    "copy": bytecopy,
+    "symlink": symlink,
+}
+
+
+def get_chain(mode):
+    """Return the ways of copying to try, in order
+    >>> get_chain('auto'), get_chain('hardlink')
+    (['reflink', 'hardlink', 'copy'], ['hardlink', 'copy'])
+    """
+    if mode not in MODES:
+        raise ValueError("Asset mode must be one of: %s" % ", ".join(MODES))
+    if mode == "auto":
+        return ["reflink", "hardlink", "copy"]
+    if mode in ("copy", "symlink"):
+        return [mode]
+    return [mode, "copy"]
+
+
+def mirror(_src, _dst, mode="auto"):
+    """Mirror a file into `_dst`, replacing atomically the old file, and
+    return the way used"""
+    directory, name = os.path.split(_dst)
+    tmppath = os.path.join(directory, "." + name + ".sync")
+    if os.path.lexists(tmppath):
+        os.remove(tmppath)
+    srcdev = os.stat(_src).st_dev
+    dstdev = os.stat(directory or os.curdir).st_dev
+    chain = get_chain(mode)
+    for way in chain:
+        key = (way, srcdev, dstdev)
+        if key in _unsupported and way != chain[-1]:
+            continue
+        try:
+            COPIES[way](_src, tmppath)
+        except OSError as err:
+            if os.path.lexists(tmppath):
+                os.remove(tmppath)
+            if way == chain[-1] or err.errno == errno.ENOENT:
+                raise
+            _unsupported.add(key)
+            continue
+        os.replace(tmppath, _dst)
+        return way
+
+
+class Plan:
+    """What must be done to mirror the assets into a directory
+    >>> plan = Plan('build', [('examples/copy.txt', 'build/copy.txt')])
+    >>> plan.todo, plan.skipped, plan.orphans
+    ([('examples/copy.txt', 'build/copy.txt')], 0, [])
+    """
+
+    def __init__(self, dest, assets, mode="auto", checksum=False, keep=(), jobs=1):
+        get_chain(mode)
+        self.dest = dest
+        self.mode = mode
+        self.assets = sorted(assets, key=lambda asset: asset[1])
+        self.dirs = sorted({os.path.dirname(dst) for _, dst in self.assets})
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+            fresh = list(
+                pool.map(
+                    lambda asset: uptodate(asset[0], asset[1], mode, checksum),
+                    self.assets,
+                )
+            )
+        self.todo = [asset for asset, ok in zip(self.assets, fresh) if not ok]
+        self.skipped = len(self.assets) - len(self.todo)
+        # remove only what the previous run mirrored
+        current = {os.path.normpath(dst) for _, dst in self.assets}
+        current.update(os.path.normpath(path) for path in keep)
+        self.orphans = [
+            path
+            for path in self.previous()
+            if path not in current and os.path.lexists(path)
+        ]
+
+    def statepath(self):
+        """Return the path of the state of the mirror"""
+        return os.path.join(self.dest, ASSETS)
+
+    def previous(self):
+        """Return the assets mirrored by the previous run"""
+        try:
+            with open(self.statepath(), "r") as fstate:
+                names = json.load(fstate).get("assets", [])
+        except (OSError, ValueError):
+            return []
+        return [os.path.normpath(os.path.join(self.dest, name)) for name in names]
+
+    def save(self):
+        """Write the state of the mirror, no state without assets"""
+        path = self.statepath()
+        if not self.assets:
+            if os.path.isfile(path):
+                os.remove(path)
+            return
+        names = [os.path.relpath(dst, self.dest) for _, dst in self.assets]
+        with open(path, "w") as fstate:
+            json.dump({"assets": names}, fstate, indent=1)
+
+
+def copyasset(_src, _dst, mode):
+    """Mirror a single asset, recording it in the profile"""
+    with profiler.span("copy", _src) as info:
+        way = mirror(_src, _dst, mode)
+        if profiler.enabled() and way == "copy":
+            info["bytes"] = os.path.getsize(_dst)
+    return way
+
+
+def execute(plan, jobs=THREADS):
+    """Run a plan, return how many files were mirrored in each way, and how
+    many were skipped and removed"""
+    # the directories are made here, the threads only copy
+    for directory in plan.dirs:
+        INDEX.makedir(directory or os.curdir)
+    stats = {"skipped": plan.skipped, "removed": 0}
+    if plan.todo:
+        srcs, dsts = zip(*plan.todo)
+        with ThreadPoolExecutor(max_workers=max(min(jobs, len(srcs)), 1)) as pool:
+            ways = list(pool.map(copyasset, srcs, dsts, [plan.mode] * len(srcs)))
+        for way in ways:
+            stats[way] = stats.get(way, 0) + 1
+    for path in plan.orphans:
+        os.remove(path)
+        stats["removed"] += 1
+        # remove the directories left empty, up to the destination
+        directory = os.path.dirname(path)
+        while os.path.abspath(directory) != os.path.abspath(plan.dest):
+            try:
+                INDEX.removedir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+    plan.save()
+    return stats
+
+
+def sync(dest, assets, mode="auto", checksum=False, keep=(), jobs=THREADS):
+    """Mirror the assets, a list of source and destination paths, inside
+    `dest`; `keep` are the other outputs of the build, never removed"""
+    plan = Plan(dest, assets, mode, checksum, keep, jobs)
+    return execute(plan, jobs)
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Parsed table layer shared by the filters.
+
+Every csv file is parsed once and kept in memory, the parsed tables are
+indexed by path, modification time, size and delimiter. In this way the
+`table`, `datatab` and any other filter reading the same file, in the
+same template or in different templates of the same run, share the
+same rows.
+
+Besides csv, the tables can be Parquet, Feather/Arrow IPC (with pyarrow)
+or NumPy .npy/.npz files (with numpy), recognized by their extension. They
+are memory mapped where possible and only the columns needed are read;
+their first row is made by the names of the columns.
+"""
+import csv
+import os
+import threading
+from collections import OrderedDict
+
+from profiler import count
+
+# default memory budget of the table cache, in bytes of csv files
+MAXBYTES = 256 * 1024 * 1024
+# binary formats, by extension
+ARROW = (".parquet", ".feather", ".arrow", ".ipc")
+NUMPY = (".npy", ".npz")
+# rows converted at a time from the binary formats
+BLOCKSIZE = 4096
+
+
+def sortkey(cell):
+    """Return the key used to compare and sort the cells, the numbers come
+    before the strings
+    >>> sortkey('1.5'), sortkey('Pippo')
+    ((0, 1.5), (1, 'Pippo'))
+    """
+    try:
+        return (0, float(cell))
+    except (TypeError, ValueError):
+        return (1, str(cell))
+
+
+class Table:
+    """A csv file parsed in memory
+    >>> tab = Table('examples/some.csv')
+    >>> tab.ncols, len(tab)
+    (3, 3)
+    >>> tab.rows[0]
+    ['Name', 'Weight', 'Heigth']
+    >>> tab.index['Weight'], tab.keys(1)[1:]
+    (1, [(0, 58.789), (0, 16.983)])
+    """
+
+    def __init__(self, path, delimiter=",", columns=None):
+        self.path = path
+        self.delimiter = delimiter
+        if isbinary(path):
+            self.rows = list(iter_table(path, delimiter, columns))
+        else:
+            with open(path, "r") as f_csv:
+                self.rows = [r for r in csv.reader(f_csv, delimiter=delimiter)]
+        self.ncols = len(self.rows[0]) if self.rows else 0
+        self.nbytes = os.path.getsize(path)
+        count("bytes", self.nbytes)
+        self._index = None
+        self._keys = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    @property
+    def index(self):
+        """Return the position of the columns by name, from the first row"""
+        if self._index is None:
+            names = self.rows[0] if self.rows else []
+            # built aside, the threads of a server see it only when complete
+            index = {}
+            for i, name in enumerate(names):
+                index.setdefault(name, i)
+            self._index = index
+        return self._index
+
+    def keys(self, col):
+        """Return the sort key of each cell of a column, the keys are made
+        once and shared by all the queries on the table"""
+        keys = self._keys.get(col)
+        if keys is None:
+            keys = [sortkey(row[col]) if col < len(row) else (1, "") for row in self]
+            self._keys[col] = keys
+        return keys
+
+
+class TableCache:
+    """Least recently used cache of parsed tables, the size of the cache
+    is the sum of the size of the parsed files. The cache is shared by the
+    threads of the render server, its state changes under a lock
+    >>> cache = TableCache()
+    >>> tab = cache.get('examples/some.csv')
+    >>> cache.get('examples/some.csv') is tab
+    True
+    >>> cache.get('examples/some.csv', delimiter=';') is tab
+    False
+    >>> cache.hits, cache.misses
+    (1, 2)
+    >>> cache.maxbytes = 0
+    >>> tab = cache.get('examples/some.csv', delimiter='|')
+    >>> len(cache), cache.nbytes == tab.nbytes
+    (1, True)
+
+    Many threads at the same time keep the size right, the threads are
+    switched often to mix their steps
+    >>> import sys
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> interval = sys.getswitchinterval(); sys.setswitchinterval(1e-6)
+    >>> cache = TableCache(maxbytes=150)
+    >>> with ThreadPoolExecutor(8) as pool:
+    ...     _ = list(pool.map(lambda i: cache.get('examples/some.csv', ',;:|.'[i % 5]),
+    ...                       range(5000)))
+    >>> sys.setswitchinterval(interval)
+    >>> cache.nbytes == sum(tab.nbytes for tab in cache._tables.values()) <= 150
+    True
+    >>> cache.hits + cache.misses
+    5000
+    """
+
+    def __init__(self, maxbytes=MAXBYTES):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def key(self, path, delimiter, columns=None):
+        """Return the key used to index a file, the columns matter only for
+        the binary formats"""
+        stat = os.stat(path)
+        if columns is not None and isbinary(path):
+            delimiter = (delimiter,) + tuple(columns)
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, delimiter)
+
+    def peek(self, path, delimiter=",", columns=None):
+        """Return the parsed table if it is already in the cache,
+        without parsing the file, otherwise return None"""
+        key = self.key(path, delimiter, columns)
+        with self._lock:
+            return self._tables.get(key)
+
+    def get(self, path, delimiter=",", columns=None):
+        """Return the parsed table, parsing the file only if the file is
+        not in the cache or if it is changed. Of the binary formats only
+        `columns` are read, all if None"""
+        key = self.key(path, delimiter, columns)
+        with self._lock:
+            tab = self._tables.get(key)
+            if tab is not None:
+                self._tables.move_to_end(key)
+                self.hits += 1
+                return tab
+            self.misses += 1
+        # parsed out of the lock, the other tables are still served
+        return self.put(key, Table(path, delimiter, columns))
+
+    def put(self, key, tab):
+        """Store a parsed table and return the table in the cache, a table
+        parsed at the same time by another thread wins"""
+        with self._lock:
+            if key in self._tables:
+                return self._tables[key]
+            # remove the old versions of the file
+            for old in [k for k in self._tables if k[0] == key[0] and k[3] == key[3]]:
+                self.nbytes -= self._tables.pop(old).nbytes
+            self._tables[key] = tab
+            self.nbytes += tab.nbytes
+            self.evict()
+        return tab
+
+    def evict(self):
+        """Remove the least recently used tables until the cache fits, keep
+        at least the last table. Called with the lock held"""
+        while self.nbytes > self.maxbytes and len(self._tables) > 1:
+            _, old = self._tables.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def clear(self):
+        """Remove all the tables from the cache"""
+        with self._lock:
+            self._tables.clear()
+            self.nbytes = 0
+
+
+TABLES = TableCache()
+
+
+def get_table(path, delimiter=",", columns=None):
+    """Return the parsed table of a file, using the shared cache"""
+    return TABLES.get(path, delimiter, columns)
+
+
+def isbinary(path):
+    """Return True if the file is in one of the binary formats
+    >>> isbinary('data.parquet'), isbinary('data.NPZ'), isbinary('data.csv')
+    (True, True, False)
+    """
+    return os.path.splitext(path)[1].lower() in ARROW + NUMPY
+
+
+def get_pyarrow():
+    """Return the pyarrow module, needed only by the Parquet and Feather
+    files"""
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError(
+            "Parquet and Feather tables require pyarrow, try: pip install pyarrow"
+        )
+    return pyarrow
+
+
+def get_np():
+    """Return the numpy module, needed only by the .npy and .npz files"""
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("NumPy tables require numpy, try: pip install numpy")
+    return numpy
+
+
+class ArrowReader:
+    """Columns of a Parquet or Feather/Arrow IPC file, memory mapped"""
+
+    def __init__(self, path):
+        pyarrow = get_pyarrow()
+        self.path = path
+        if path.lower().endswith(".parquet"):
+            import pyarrow.parquet
+
+            self.parquet = pyarrow.parquet.ParquetFile(path, memory_map=True)
+            self.names = list(self.parquet.schema_arrow.names)
+            self.nrows = self.parquet.metadata.num_rows
+        else:
+            import pyarrow.feather
+
+            self.parquet = None
+            # zero copy, the buffers point into the mapped file
+            self.table = pyarrow.feather.read_table(path, memory_map=True)
+            self.names = list(self.table.column_names)
+            self.nrows = self.table.num_rows
+
+    def blocks(self, columns):
+        """Return an iterator over the blocks of rows of some columns"""
+        if self.parquet is not None:
+            batches = self.parquet.iter_batches(batch_size=BLOCKSIZE, columns=columns)
+        else:
+            batches = self.table.select(columns).to_batches(max_chunksize=BLOCKSIZE)
+        for batch in batches:
+            yield zip(*[column.to_pylist() for column in batch.columns])
+
+
+class NumpyReader:
+    """Columns of a .npy file, memory mapped, or of a .npz file. The columns
+    of a .npy are the fields of a structured array or the columns of a two
+    dimensional array, named col0, col1, ... The columns of a .npz are its
+    one dimensional arrays
+    >>> import numpy
+    >>> numpy.savez('examples/some.npz', Name=['Pippo', 'Pluto'],
+    ...             Weight=[58.789, 16.983])
+    >>> reader = NumpyReader('examples/some.npz')
+    >>> reader.names, reader.nrows
+    (['Name', 'Weight'], 2)
+    >>> [list(block) for block in reader.blocks(['Weight'])]
+    [[(58.789,), (16.983,)]]
+    >>> os.remove('examples/some.npz')
+    """
+
+    def __init__(self, path):
+        numpy = get_np()
+        self.path = path
+        if path.lower().endswith(".npz"):
+            # the arrays of a .npz are read when needed, with the file
+            # open only while they are read
+            self.data = None
+            with numpy.load(path) as npz:
+                self.names = list(npz.files)
+                self.nrows = len(npz[self.names[0]]) if self.names else 0
+        else:
+            array = numpy.load(path, mmap_mode="r")
+            if array.dtype.names:
+                self.data = array
+                self.names = list(array.dtype.names)
+            else:
+                if array.ndim == 1:
+                    array = array.reshape(-1, 1)
+                self.data = {"col%d" % i: array[:, i] for i in range(array.shape[1])}
+                self.names = list(self.data)
+            self.nrows = len(self.data[self.names[0]]) if self.names else 0
+
+    def blocks(self, columns):
+        """Return an iterator over the blocks of rows of some columns, only
+        the arrays of these columns are read"""
+        if self.data is None:
+            with get_np().load(self.path) as npz:
+                arrays = [npz[name] for name in columns]
+        else:
+            arrays = [self.data[name] for name in columns]
+        for start in range(0, self.nrows, BLOCKSIZE):
+            yield zip(*[array[start : start + BLOCKSIZE].tolist() for array in arrays])
+
+
+def get_reader(path):
+    """Return the reader of a file in a binary format"""
+    if os.path.splitext(path)[1].lower() in NUMPY:
+        return NumpyReader(path)
+    return ArrowReader(path)
+
+
+def get_columns(path, delimiter=","):
+    """Return the names of the columns of a file, the first row of a csv
+    >>> get_columns('examples/some.csv')
+    ['Name', 'Weight', 'Heigth']
+    """
+    if isbinary(path):
+        return get_reader(path).names
+    return next(iter_csv(path, delimiter), [])
+
+
+def iter_table(path, delimiter=",", columns=None):
+    """Return an iterator over the rows of a file, csv or binary, reading
+    it row by row or block by block. The first row of a binary file has the
+    names of the `columns`, all if None, the values are converted to text
+    only when they are formatted"""
+    if not isbinary(path):
+        yield from iter_csv(path, delimiter)
+        return
+    reader = get_reader(path)
+    columns = reader.names if columns is None else list(columns)
+    yield columns
+    for block in reader.blocks(columns):
+        for row in block:
+            yield ["" if cell is None else cell for cell in row]
+
+
+def iter_csv(path, delimiter=","):
+    """Return an iterator over the rows of a csv file, the file is read
+    row by row and never kept in memory
+    >>> next(iter_csv('examples/some.csv'))
+    ['Name', 'Weight', 'Heigth']
+    """
+    with open(path, "r") as f_csv:
+        for row in csv.reader(f_csv, delimiter=delimiter):
+            yield row
+
+
+def count_rows(path, delimiter=","):
+    """Return the number of rows of a csv file, without parsing the file
+    if the table is already in the cache
+    >>> count_rows('examples/some.csv')
+    3
+    """
+    tab = TABLES.peek(path, delimiter)
+    if tab is not None:
+        return len(tab)
+    if isbinary(path):
+        return get_reader(path).nrows + 1
+    return sum(1 for _ in iter_csv(path, delimiter))
+
+
+def count_cols(path, delimiter=","):
+    """Return the number of columns of a csv file, reading only the first
+    row if the table is not already in the cache
+    >>> count_cols('examples/some.csv')
+    3
+    """
+    tab = TABLES.peek(path, delimiter)
+    if tab is not None:
+        return tab.ncols
+    return len(get_columns(path, delimiter))
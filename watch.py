@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Watch the sources of a document and build it again when they change.
+
+On linux the directories are watched through inotify, on the other
+systems the state of the files is polled.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+import traceback
+
+# inotify events that could change an output
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+
+
+def isexcluded(path, exclude):
+    """Return True if path is one of the excluded directories or is inside
+    >>> isexcluded('/a/build/x.tex', ['/a/build']), isexcluded('/a/b', ['/a/build'])
+    (True, False)
+    """
+    for excl in exclude:
+        if path == excl or path.startswith(excl + os.sep):
+            return True
+    return False
+
+
+def expand(paths, exclude=()):
+    """Return the directories to watch, the directories in `paths` with
+    all their subdirectories, and the single files to watch"""
+    exclude = [os.path.abspath(excl) for excl in exclude]
+    dirs = set()
+    files = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            for root, subdirs, _ in os.walk(path):
+                subdirs[:] = [
+                    sub
+                    for sub in subdirs
+                    if not isexcluded(os.path.join(root, sub), exclude)
+                ]
+                if not isexcluded(root, exclude):
+                    dirs.add(root)
+        else:
+            files.add(path)
+    return sorted(dirs), sorted(files)
+
+
+class PollWatcher:
+    """Look at the state of the files every `interval` seconds"""
+
+    def __init__(self, exclude=(), interval=0.5):
+        self.exclude = exclude
+        self.interval = interval
+        self.state = None
+
+    def snapshot(self, paths):
+        """Return the modification time and size of the watched files"""
+        state = {}
+        dirs, files = expand(paths, self.exclude)
+        for directory in dirs:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    state[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        for path in files:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            state[path] = stat and (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    def wait(self, paths, timeout=None):
+        """Wait for a change, return False if nothing changed in `timeout`"""
+        if self.state is None:
+            self.state = self.snapshot(paths)
+        start = time.time()
+        while True:
+            state = self.snapshot(paths)
+            if state != self.state:
+                self.state = state
+                return True
+            if timeout is not None and time.time() - start >= timeout:
+                return False
+            time.sleep(self.interval)
+
+
+class InotifyWatcher:
+    """Receive the changes of the watched directories from inotify, the
+    single files are watched through their directory"""
+
+    def __init__(self, exclude=()):
+        self.exclude = exclude
+        libname = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor: directory, True if all its files are watched
+        self.watched = {}
+        self.files = set()
+
+    def addwatch(self, paths):
+        """Watch the directories and the files"""
+        dirs, files = expand(paths, self.exclude)
+        self.files = set(files)
+        targets = [(d, True) for d in dirs]
+        targets += [(os.path.dirname(f), False) for f in files]
+        known = {d: full for d, full in self.watched.values()}
+        for directory, full in targets:
+            if known.get(directory) is True or (directory in known and not full):
+                continue
+            if not os.path.isdir(directory):
+                continue
+            wdesc = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(directory), IN_MASK
+            )
+            if wdesc >= 0:
+                self.watched[wdesc] = (directory, full or known.get(directory, False))
+                known[directory] = self.watched[wdesc][1]
+
+    def readevents(self):
+        """Return True if one of the events is about a watched file"""
+        relevant = False
+        try:
+            while True:
+                buf = os.read(self.fd, 65536)
+                if not buf:
+                    break
+                pos = 0
+                while pos < len(buf):
+                    wdesc, mask, _, size = struct.unpack_from("iIII", buf, pos)
+                    name = buf[pos + 16 : pos + 16 + size].rstrip(b"\0")
+                    pos += 16 + size
+                    directory, full = self.watched.get(wdesc, (None, False))
+                    if directory is None:
+                        continue
+                    path = os.path.join(directory, os.fsdecode(name))
+                    if full or path in self.files or not name:
+                        relevant = True
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                        self.watched.pop(wdesc, None)
+        except BlockingIOError:
+            pass
+        return relevant
+
+    def wait(self, paths, timeout=None):
+        """Wait for a change, return False if nothing changed in `timeout`"""
+        self.addwatch(paths)
+        start = time.time()
+        while True:
+            left = None if timeout is None else max(timeout - (time.time() - start), 0)
+            ready, _, _ = select.select([self.fd], [], [], left)
+            if not ready:
+                return False
+            if self.readevents():
+                return True
+
+
+def get_watcher(exclude=(), interval=0.5):
+    """Return an inotify watcher if possible, a polling watcher otherwise"""
+    try:
+        return InotifyWatcher(exclude=exclude)
+    except (OSError, AttributeError, TypeError):
+        return PollWatcher(exclude=exclude, interval=interval)
+
+
+def describe(err):
+    """Return a message for an error of a build, with the template and the
+    line for the errors of the templates
+    >>> import jinja2
+    >>> try:
+    ...     jinja2.Environment().parse('{{ x }}\\n{{ broken', 'simple.tex')
+    ... except Exception as err:
+    ...     print(describe(err)) # doctest:+ELLIPSIS
+    simple.tex:2: TemplateSyntaxError: unexpected end of template, expected ...
+    >>> describe(ValueError('Unknown column'))
+    'ValueError: Unknown column'
+    """
+    message = "{0}: {1}".format(type(err).__name__, err)
+    filename = getattr(err, "filename", None) or getattr(err, "name", None)
+    lineno = getattr(err, "lineno", None)
+    if not (filename and lineno):
+        # jinja puts the lines of the templates in the traceback, the
+        # files of the templates are not python files
+        frames = [
+            frame
+            for frame in traceback.extract_tb(err.__traceback__)
+            if not frame.filename.endswith(".py") and not frame.filename.startswith("<")
+        ]
+        if not frames:
+            return message
+        filename, lineno = frames[-1].filename, frames[-1].lineno
+    return "{0}:{1}: {2}".format(filename, lineno, message)
+
+
+def rebuild(build):
+    """Call `build`, print its error instead of stopping the watch, return
+    True if the build worked
+    >>> rebuild(lambda: int('x'))
+    Build failed: ValueError: invalid literal for int() with base 10: 'x'
+    False
+    """
+    try:
+        build()
+    except Exception as err:
+        print("Build failed: {0}".format(describe(err)))
+        return False
+    return True
+
+
+def watch(build, getpaths, exclude=(), interval=0.5, debounce=0.3):
+    """Call `build` and then call it again each time the files returned by
+    `getpaths` change. The changes that arrive within `debounce` seconds
+    one from the other are collected in a single build, a failed build is
+    reported and the watch goes on"""
+    watcher = get_watcher(exclude=exclude, interval=interval)
+    rebuild(build)
+    print("Watching for changes, press Ctrl+C to stop")
+    try:
+        while True:
+            watcher.wait(getpaths())
+            # wait until the burst of changes is finished
+            while watcher.wait(getpaths(), timeout=debounce):
+                pass
+            rebuild(build)
+    except KeyboardInterrupt:
+        print("Stop watching")